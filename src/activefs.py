@@ -1,13 +1,19 @@
 #!/usr/bin/env python
 
 from itertools import *
-from functools import reduce
 import random
+import heapq
 import job
 import event
 import sched
 import logging
 import iomodel
+import network
+import cache
+import metrics
+
+# destination of the transfers for the tasks offloaded to the host
+HOST = -2
 
 bin_map = dict({    "fits.tbl":3,
                     "mAdd":1,
@@ -44,9 +50,10 @@ class AFECore(event.TimeoutEventHandler):
         self.n_read = 0
         self.n_written = 0
         self.running = None
-        self.idle_event = event.TimeoutEvent('idle', 1, self)
+        self.metrics = metrics.DeviceMetrics()
+        self.idle_event = event.TimeoutEvent(event.IDLE, 1, self)
         self.idle_event.set_disposable()
-        self.task_event = event.TimeoutEvent('task', 0, self)
+        self.task_event = event.TimeoutEvent(event.TASK, 0, self)
         self.ev.register_module(self)
         logging.basicConfig (level=logging.DEBUG,
                              format='%(asctime)s - %(levelname)s - %(message)s')
@@ -74,45 +81,60 @@ class AFECore(event.TimeoutEventHandler):
         if self.running != None:
             return
 
+        if len(self.tq) == 0 and self.afs.config.steal != 'none':
+            self.activeflash.steal_from_cores(self)
+
         if len(self.tq) > 0:
             # We get the first task from the task queue
             task = self.tq.pop(0)
+            now = self.ev.now()
+            self.metrics.queue.update(now, len(self.tq))
+            self.activeflash.metrics.queue.add(now, -1)
             # We mark the task as being the one executed on the core
             self.running = task
 
-            desc = '%s (%.3f sec) execution' % (task.name, task.runtime)
-
             # We set the execution start time of the task
             task.started(self.ev.now())
 
             self.logger.info ('Executing task %s (runtime %.3f)' % (task.name, task.runtime))
 
-            # We set an event that will simulate the task termination
-            self.task_event.set_timeout(task.runtime)
-            self.task_event.set_context(task)
-            self.task_event.set_description(desc)
-            self.ev.register_event(self.task_event)
+            runtime = self.activeflash.get_runtime(task)
+            self.activeflash.work_started(task, runtime)
+            if self.activeflash.flash != None:
+                # IO phase first, shared with the other cores
+                self.activeflash.flash.start_io(self, task, runtime)
+            else:
+                self.io_done(task, runtime)
 
             # We set an event at the activeflash device level so it can get
             # the task termination notification
             #self.activeflash.task_event.set_timeout(task.runtime)
             #self.activeflash.task_event.set_context(task)
-            #self.activeflash.task_event.set_description(desc)
+            #self.activeflash.task_event.set_description(...)
             #self.ev.register_event(self.activeflash.task_event)
 
+    def io_done(self, task, compute):
+        # We set an event that will simulate the task termination
+        self.task_event.set_timeout(compute)
+        self.task_event.set_context(task)
+        self.task_event.set_description('%s (%.3f sec) execution',
+                                        task.name, task.runtime)
+        self.ev.register_event(self.task_event)
+
     def submit_task(self, task):
         self.tq.append(task)
+        self.metrics.queue.update(self.ev.now(), len(self.tq))
         # Submission time is when the task is added to the meta queue at the
         # activeflash device level so nothing to do to that regard here
         self.try_execute_task()
 
     def handle_timeout(self, e):
-        if self.afs.config.eventlog:
+        if self.ev.tracing:
             self.logger.debug ('(%.3f, %.3f) --- %s [%s] %s' \
                   % (e.registered, e.timeout, self.get_name(),
-                     e.name, e.description))
+                     e.name, e.get_description()))
 
-        if e.name == 'task':
+        if e.kind == event.TASK:
             self.handle_timeout_task(e)
 
     """Handles task completion event
@@ -124,26 +146,37 @@ class AFECore(event.TimeoutEventHandler):
         self.logger.debug ("Task %s terminated" % task.name)
         
         # We set the execution end time of the task
-        task.completed(self.ev.now())
+        prepared = task.completed(self.ev.now())
+        self.activeflash.work_completed(task)
+        self.activeflash.place_outputs(task)
         # Run one execution iteration of the simulator (task_completed does
         # nothing but execute advance())
-        self.afs.task_completed(task, self)
+        self.afs.task_completed(task, self, prepared)
         # We update the core's performance metrics based on the execution of
         # the task
+        self.metrics.task_completed(task)
         self.update_data_rw(task)
         # We mark the core as not running any task
         self.running = None
+        self.activeflash.core_released(self, task)
         # We see if another task can be executed
         self.try_execute_task()
+        if self.afs.config.steal == 'all':
+            self.afs.steal_for_idle_devices()
+
+    def remaining_time(self):
+        """time until the core is done with its running and queued tasks"""
+        wait = 0.0
+        if self.running != None:
+            wait = self.running.stat.t_start + self.running.runtime - \
+                    self.ev.now()
+        for task in self.tq:
+            wait += task.runtime
+        return wait
 
     def update_data_rw(self, task):
-        r, w = 0, 0
-        if len(task.input) > 0:
-            r = reduce(lambda x, y: x+y, [ f.size for f in task.input ])
-        if len(task.output) > 0:
-            w = reduce(lambda x, y: x+y, [ f.size for f in task.output ])
-        self.data_read(r)
-        self.data_write(w)
+        self.data_read(task.input_bytes)
+        self.data_write(task.output_bytes)
 
     def data_read(self, count):
         self.n_read += count
@@ -163,15 +196,28 @@ class ActiveFlash(event.TimeoutEventHandler):
         self.tq = []
         self.cores = []
         self.ev.register_module(self)
-        self.idle_event = event.TimeoutEvent('idle', 1, self)
+        self.idle_event = event.TimeoutEvent(event.IDLE, 1, self)
         self.idle_event.set_disposable()
-        self.task_event = event.TimeoutEvent('task', 0, self)
+        self.task_event = event.TimeoutEvent(event.TASK, 0, self)
         """statistics"""
         self.n_read = 0         # how much is read/written?
         self.n_written = 0
         self.n_extra_read = 0   # how much rw for data transfer?
         self.n_extra_written = 0
+        self.metrics = metrics.DeviceMetrics()
+        self.init_work()
         self.num_cores = self.afs.config.cores
+        # internal flash bandwidth shared by the cores (or part of the
+        # task runtime)
+        self.flash = None
+        if self.config.flash_contention:
+            self.flash = iomodel.FlashChannels(ev, self.config.flash_channels,
+                                               self.config.channel_bw)
+        # replicas of files placed on other AFEs, unbounded by default
+        self.cache = None
+        if self.config.cache_size > 0:
+            self.cache = cache.ReplicaCache(id, self.config.cache_size,
+                                            self.config.cache_policy)
 
         logging.basicConfig (level=logging.DEBUG,
                              format='%(asctime)s - %(levelname)s - %(message)s')
@@ -195,10 +241,8 @@ class ActiveFlash(event.TimeoutEventHandler):
         for i in range(len(self.cores)):
             core = self.cores[i]
         # Initialize the device's scheduler
-        if (afs.config.deviceScheduler == 'firstavailable'):
-            self.device_scheduler = sched.DeviceSchedFirstFreeCore()
-        else:
-            self.device_scheduler = sched.DeviceSchedFirstFreeCore()
+        self.device_scheduler = sched.device_schedulers[ \
+                afs.config.deviceScheduler.lower()](self)
 
     def get_name(self):
         return 'ActiveFlash-' + str(self.id)
@@ -211,14 +255,45 @@ class ActiveFlash(event.TimeoutEventHandler):
 
     def submit_task(self, task):
         self.tq.append(task)
+        self.metrics.queue.add(self.ev.now(), 1)
+        self.work_queued(task, 1)
         task.submitted(self.ev.now())
         self.try_assign_task()
 
+    def init_work(self):
+        """work of the AFE, maintained as the tasks are submitted, start and
+        complete (see get_qtime)
+        """
+        self.n_queued = 0
+        self.queued_work = 0.0  # runtimes of the tasks in any queue
+        self.n_running = 0
+        self.running_end = 0.0  # expected completion times of running tasks
+
+    def work_queued(self, task, count):
+        """the task enters (count 1) or leaves (-1) the queues of the AFE"""
+        self.n_queued += count
+        self.queued_work += count * self.get_runtime(task)
+        if self.n_queued == 0:
+            self.queued_work = 0.0
+
+    def work_started(self, task, runtime):
+        self.work_queued(task, -1)
+        self.n_running += 1
+        self.running_end += task.stat.t_start + runtime
+
+    def work_completed(self, task):
+        self.n_running -= 1
+        self.running_end -= task.stat.t_start + self.get_runtime(task)
+        if self.n_running == 0:
+            self.running_end = 0.0
+
     def get_qtime(self):
-        wait = 0.0
-        for task in self.tq:
-            wait += task.runtime
-        return wait
+        """estimated time until a core becomes available: the queued work and
+        the remaining time of the running tasks (core queues included),
+        spread over the cores
+        """
+        remaining = self.running_end - self.n_running * self.ev.now()
+        return max(self.queued_work + remaining, 0.0) / self.num_cores
 
     def set_idle_timeout(self):
         # The simulation will run only if events are present in the
@@ -241,31 +316,73 @@ class ActiveFlash(event.TimeoutEventHandler):
             # No task to schedule, we return
             return
 
-        l = 0
-        #while (len(self.tq) > 0):
-        if (len (self.tq) > 0):
+        while (len (self.tq) > 0):
             # The scheduler is based on the following premise:
-            # - we get the first task from the queue
+            # - we get the next task from the queue
             # - we try to scheduler the task on a core
             # - if the scheduler returns SCHED_LOOP_DONE, we stop
-            # - if the scheduler returns SCHED_LOOP_CONT, the task cannot be
-            #   assigned to a core but we can try to schedule another task
             # - if the scheduler returns a core ID, we assign the task to that core
-            task = self.tq[l]
+            l = self.device_scheduler.next_task(self)
 
             # Call the scheduler
-            core_id = self.config.py_lat_module.lat_device_sched_task ()
+            core_id = self.device_scheduler.schedule_task(self, self.tq[l])
+            if core_id == sched.DeviceScheduler.SCHED_LOOP_DONE:
+                break
             task = self.tq.pop(l)
             self.cores[core_id].submit_task(task)
-            l = l + 1
+
+        if self.afs.config.steal != 'none':
+            # idle cores pull the tasks queued behind a busy one
+            for core in self.cores:
+                core.try_execute_task()
+
+    def steal_from_cores(self, core):
+        """an idle core takes the oldest queued task of its most loaded
+        sibling
+        """
+        victim = None
+        for c in self.cores:
+            if c is not core and len(c.tq) > 0 and \
+               (victim == None or len(c.tq) > len(victim.tq)):
+                victim = c
+        if victim != None:
+            task = victim.tq.pop(0)
+            self.logger.debug ("Core %d steals task %s from core %d" % \
+                               (core.core_id, task.name, victim.core_id))
+            core.tq.append(task)
+            victim.metrics.queue.update(self.ev.now(), len(victim.tq))
+            core.metrics.queue.update(self.ev.now(), len(core.tq))
+            self.afs.num_steals[0] += 1
+
+    def get_runtime(self, task):
+        return task.runtime
+
+    def place_outputs(self, task):
+        """the outputs of a task stay on the AFE running it"""
+        pass
+
+    def core_released(self, core, task):
+        # the core was busy with the IO phase of the task as well
+        busy = task.stat.t_complete - task.stat.t_start
+        self.device_scheduler.core_released(core.core_id, busy)
+        self.try_assign_task()
+
+    def is_idle(self):
+        if len(self.tq) > 0:
+            return False
+        for core in self.cores:
+            if core.running != None or len(core.tq) > 0:
+                return False
+        return True
 
     # Handler executed when idle. Note that a core directly invoke that
     # function, not the event system.
     def handle_timeout(self, e):
-        self.logger.debug ('(%.3f, %.3f) --- %s [%s] %s' \
+        if self.ev.tracing:
+            self.logger.debug ('(%.3f, %.3f) --- %s [%s] %s' \
                   % (e.registered, e.timeout, self.get_name(),
-                     e.name, e.description))
-        if e.name == 'task':
+                     e.name, e.get_description()))
+        if e.kind == event.TASK:
             self.handle_timeout_task(e)
         else:
             self.try_assign_task()
@@ -276,28 +393,23 @@ class ActiveFlash(event.TimeoutEventHandler):
         if (e == None):
             raise SystemExit('BUG')
         task = e.get_context()
-        self.afs.task_completed(task, self)
+        prepared = []
         for f in task.output:
-            if (f.size < 0):
-                # The file is now produced, mark it accordingly
-                f.size = -f.size
+            # The file is now produced, mark it accordingly
+            prepared += f.produced()
             if (f.location < 0):
                 f.location = self.id
             else:
                 print "Output file %s already exists? (%d vs %d)" % (f.name, f.location, self.id)
+        self.afs.task_completed(task, self, prepared)
         self.update_data_rw(task)
         self.try_assign_task()
 
     def update_data_rw(self, task):
         if (task == None):
             raise SystemExit('BUG')
-        r, w = 0, 0
-        if len(task.input) > 0:
-            r = reduce(lambda x, y: x+y, [ f.size for f in task.input ])
-        if len(task.output) > 0:
-            w = reduce(lambda x, y: x+y, [ f.size for f in task.output ])
-        self.data_read(r)
-        self.data_write(w)
+        self.data_read(task.input_bytes)
+        self.data_write(task.output_bytes)
 
     def data_read(self, count):
         self.n_read += count
@@ -323,86 +435,96 @@ class ActiveFlash(event.TimeoutEventHandler):
     def get_extra_write(self):
         return self.n_extra_written
 
+    def get_evicted(self):
+        if self.cache == None:
+            return 0
+        return self.cache.n_evicted
+
+    def get_evictions(self):
+        if self.cache == None:
+            return 0
+        return self.cache.evictions
+
 
 class ActiveHost(ActiveFlash):
-    """Host
+    """Host, its cores run the tasks offloaded from the AFEs. The input files
+    are transferred to the host like to an AFE (HOST is the destination), so
+    the host link contends with the other transfers; the output files are
+    written to the AFE chosen by the output placement policy.
     """
     def __init__(self, ev, id, afs):
         self.id = id
         self.ev = ev
         self.afs = afs
+        self.config = afs.config
         self.tq = []
         self.ev.register_module(self)
-        self.idle_event = event.TimeoutEvent('idle', 1, self)
-        self.idle_event.set_disposable()
-        self.task_event = event.TimeoutEvent('task', 0, self)
-        self.running = None
         """statistics"""
         self.n_read = 0         # how much is read/written?
         self.n_written = 0
+        self.n_extra_read = 0
+        self.n_extra_written = 0
         self.n_task = 0;        # how many tasks were processed here?
         self.last_written_osd = 0;  # write output in a RR order.
+        self.metrics = metrics.DeviceMetrics()
+        self.init_work()
+        self.cache = None
+        self.flash = None
+        self.logger = afs.logger
+        self.num_cores = self.config.host_cores
+        self.cores = [ AFECore(ev, i, self, afs) \
+                        for i in range(self.num_cores) ]
+        self.device_scheduler = sched.host_schedulers[ \
+                self.config.host_scheduler.lower()](self)
 
     def get_name(self):
         return 'Host-' + str(self.id)
 
     """here we assume that the internal NAND bandwidth is x2.56 faster than the
-    external bandwidth. (iSSD, ICS'11)
+    external bandwidth. (iSSD, ICS'11, see the flash channel options)
+    The input files are already on the host, writing the outputs to the
+    AFEs is part of the runtime.
     """
     def adjust_runtime(self, task):
-        ssd_ch_bw = 40 * (1 << 20)
-        ssd_n_ch = 32
-        bw_ssd = ssd_ch_bw * ssd_n_ch
-
-        r, w = 0, 0
-        if len(task.input) > 0:
-            r = reduce(lambda x, y: abs(x)+abs(y), [ f.size for f in task.input ])
-        if len(task.output) > 0:
-            w = reduce(lambda x, y: abs(x)+abs(y), [ f.size for f in task.output ])
+        bw_ssd = self.config.flash_channels * self.config.channel_bw
 
-        total_io = r + w
+        total_io = task.input_bytes + task.output_bytes
         t_ssd_io = float(total_io) / bw_ssd
         t_ssd_comp = task.runtime - t_ssd_io
 
-        t_comp = t_ssd_comp / self.afs.config.hostspeed
-        t_io = total_io / self.afs.config.netbw
+        t_comp = t_ssd_comp / self.config.hostspeed
+        t_io = float(task.output_bytes) / self.config.netbw
 
         return t_comp + t_io
 
-    def try_execute_task(self):
-        if self.running != None:
-            return
-
-        if len(self.tq) > 0:
-            task = self.tq.pop(0)
-            self.running = task
-            self.task_event.set_timeout(self.adjust_runtime(task))
-            self.task_event.set_context(task)
-            desc = '%s (%.3f sec) execution' % (task.name, task.runtime)
-            self.task_event.set_description(desc)
-            task.started(self.ev.now())
-            self.ev.register_event(self.task_event)
-
-    def update_data_rw(self, task):
+    def get_runtime(self, task):
+        return self.adjust_runtime(task)
+
+    def output_location(self, task):
+        osds = self.config.osds
+        if self.config.host_placement == 'input' and len(task.input) > 0:
+            # where most of the input data comes from
+            fsize = [ 0 ] * osds
+            for f in task.input:
+                fsize[f.location] += f.size
+            return fsize.index(max(fsize))
+        elif self.config.host_placement == 'least':
+            # the AFE which got the least data written so far
+            writes = [ x.get_total_write() for x in self.afs.osds ]
+            return writes.index(min(writes))
+        osd = self.last_written_osd
+        self.last_written_osd = (self.last_written_osd + 1) % osds
+        return osd
+
+    def place_outputs(self, task):
         self.n_task += 1        # update the number of tasks processed
-
-        r, w = 0, 0             # update data read/written
-        if len(task.input) > 0:
-            r = reduce(lambda x, y: x+y, [ f.size for f in task.input ])
-        if len(task.output) > 0:
-            w = reduce(lambda x, y: x+y, [ f.size for f in task.output ])
-        self.data_read(r)
-        self.data_write(w)
-
-        for f in task.input:
-            self.afs.osds[f.location].data_transfer_read(f.size)
+        self.data_read(task.input_bytes)
+        self.data_write(task.output_bytes)
         for f in task.output:
-            if self.last_written_osd < self.afs.config.osds:
-                f.location = self.last_written_osd
-                self.last_written_osd += 1
-            else:
-                f.location = self.last_written_osd = 0
+            f.location = self.output_location(task)
             self.afs.osds[f.location].data_transfer_write(f.size)
+            self.afs.osds[f.location].metrics.transfers_in += 1
+            self.metrics.transfers_out += 1
 
 
 class ActiveFS(event.TimeoutEventHandler):
@@ -416,8 +538,20 @@ class ActiveFS(event.TimeoutEventHandler):
         self.last_ts = 0.0
         self.num_transfers = 0
 
-        # Queue to store the file transfer requests
+        # Queue to store the file transfer requests, (file, [ destinations ])
         self.fq = []
+        # (file, destination) of the requested transfers not completed yet
+        self.inflight = set()
+        # file -> fq entry not started yet, to add destinations to (multicast)
+        self.queued = {}
+        # (file, destination) -> [ consumer, start, end ] of the transfers
+        # started before a consumer is prepared (prefetch), the consumer is
+        # the first one prepared on the destination
+        self.prefetched = {}
+        self.n_prefetching = 0      # prefetches in flight, and their bytes
+        self.prefetch_bytes = 0
+        self.num_prefetches = 0     # statistics
+        self.prefetch_saved = 0.0   # input stall time hidden by prefetching
 
         # Simulate the latency of invoking the thread handling the transfer of
         # files.
@@ -430,6 +564,22 @@ class ActiveFS(event.TimeoutEventHandler):
         """
         self.ongoing_file_transfer = False
 
+        """
+        With the flow network model, all the requested transfers proceed
+        concurrently and share the AFE links (max-min fairness). With the
+        channel model, they are spread over a pool of transfer workers,
+        limited by the read/write ports of the AFEs.
+        """
+        if self.config.network == 'flow':
+            self.network = network.FlowNetwork(ev, self)
+        elif self.config.network == 'channel':
+            self.network = network.ChannelNetwork(ev, self,
+                                                  self.config.transfer_workers,
+                                                  self.config.port_limit,
+                                                  self.config.transfer_queue)
+        else:
+            self.network = None
+
         """We also use the host for computation?
         if self.config.hybrid == True:
             self.host = ActiveHost(ev, 0, self)
@@ -441,7 +591,13 @@ class ActiveFS(event.TimeoutEventHandler):
         self.osds = [ ActiveFlash(ev, n, config, self) \
                         for n in range(self.config.osds) ]
         self.ev.register_module(self)
-        self.pq = []    # pre(pared) q, all data files are ready
+        self.pq = set() # pre(pared) q, all data files are ready
+        # (file, osd) -> prepared tasks waiting for that replica
+        self.waiters = {}
+        self.runnable = []  # prepared tasks which got all their replicas
+        self.n_dispatched = 0   # tasks submitted to an AFE (or the host)
+                                # and not completed yet
+        self.num_steals = [ 0, 0 ]  # between cores, between AFEs
 
         logging.basicConfig (level=logging.DEBUG,
                              format='%(asctime)s - %(levelname)s - %(message)s')
@@ -456,27 +612,42 @@ class ActiveFS(event.TimeoutEventHandler):
             self.logger.propagate = False
 
         self.iomod = iomodel.IOModel(config, "Emulator")
+        self.set_scheduler(self.config.scheduler)
 
-        if   self.config.scheduler == 'rr':
+    def set_scheduler(self, name):
+        if   name == 'rr':
             self.scheduler = sched.SchedRR(self)
-        elif self.config.scheduler == 'locality':
+        elif name == 'locality':
             self.scheduler = sched.SchedLocality(self)
-        elif self.config.scheduler == 'minwait':
+        elif name == 'minwait':
             self.scheduler = sched.SchedMinWait(self)
-        elif self.config.scheduler == 'hostonly':
+        elif name == 'hostonly':
             self.scheduler = sched.SchedHostOnly(self)
             self.set_hybrid()
-        elif self.config.scheduler == 'hostreduce':
+        elif name == 'hostreduce':
             self.scheduler = sched.SchedHostReduce(self)
             self.set_hybrid()
-        elif self.config.scheduler == 'wa':
+        elif name == 'wa':
             self.scheduler = sched.SchedWA(self)
+        elif name == 'heft':
+            self.scheduler = sched.SchedHEFT(self)
         else:
             self.scheduler = sched.SchedLib(self)
-        self.scheduler.config = config
+        self.scheduler.config = self.config
+
+    def switch_scheduler(self, name):
+        """Continue a running simulation (e.g. a forked one) with another
+        scheduler. Tasks which are not prepared yet are placed again by the
+        new scheduler, the others keep their placement.
+        """
+        self.config.scheduler = name
+        self.set_scheduler(name)
+        if self.job != None:
+            self.scheduler.job_submitted()
 
     def set_hybrid(self):
-        self.host = ActiveHost(self.ev, 0, self)
+        if self.host == None:
+            self.host = ActiveHost(self.ev, 0, self)
 
     def get_name(self):
         return 'ActiveFS'
@@ -485,10 +656,18 @@ class ActiveFS(event.TimeoutEventHandler):
         # The simulator is now ready to start to execute the workflow.
         self.last_ts = self.ev.now()
         self.logger.debug ('Initial TS: {0:.3f}'.format(self.last_ts))
+        # tq holds the submitted tasks, those having all their input files
+        # are also in the prepared heap (ordered by name)
+        self.prepared = []
+        self.prepare_event = None
         if (self.job == None):
-            self.tq = []
+            self.tq = set()
         else:
-            self.tq = list(self.job.tasks.values())
+            self.tq = set(self.job.tasks.values())
+            for task in self.tq:
+                if task.is_prepared():
+                    self.prepared.append((task.name, task))
+            heapq.heapify(self.prepared)
             self.scheduler.job_submitted()
 
     def submit_workflow(self, workflow):
@@ -522,8 +701,14 @@ class ActiveFS(event.TimeoutEventHandler):
                             sorted(self.job.files.items())))
         valid_files = list(filter(lambda x: x.size > 0, sorted_files))
 
-        for f in valid_files:
-            osd = self.config.py_lat_module.lat_host_sched_file()
+        lat = self.config.py_lat_module
+        if hasattr(lat, 'lat_host_sched_file_batch'):
+            osds = lat.lat_host_sched_file_batch(len(valid_files))
+        else:
+            osds = [ lat.lat_host_sched_file() for f in valid_files ]
+
+        for (f, osd) in zip(valid_files, osds):
+            osd = int(osd)
             """
             GV: this code is used to mimic the emulator
             _osd = bin_map.get (f.name)
@@ -551,19 +736,43 @@ class ActiveFS(event.TimeoutEventHandler):
         self.workflow_runtime = self.workflow_runtime + (now - self.last_ts)
         self.last_ts = now
 
-    def task_completed(self, task, osd):
+    def task_completed(self, task, osd, prepared):
+        self.n_dispatched -= 1
+        task.done = True
+        if task.host == True:
+            self.host.metrics.task_completed(task)
+        elif task.osd >= 0:
+            self.osds[task.osd].metrics.task_completed(task)
+        if self.config.prefetch > 0:
+            self.prefetch_outputs(task)
+        if task.host == False and self.osds[task.osd].cache != None:
+            for f in task.input:
+                self.osds[task.osd].cache.unpin(f)
+        for t in prepared:
+            heapq.heappush(self.prepared, (t.name, t))
         self.update_metrics()
         self.advance()
 
+    def destination(self, task):
+        """where the input files of a task have to be"""
+        if task.host == True:
+            return HOST
+        return task.osd
+
+    def device(self, dst):
+        if dst == HOST:
+            return self.host
+        return self.osds[dst]
+
+    def get_queue_depths(self):
+        """number of submitted, prepared and dispatched (queued or running on
+        an AFE) tasks
+        """
+        return (len(self.tq), len(self.pq), self.n_dispatched)
+
     def check_termination(self):
-        # Does any of the cores still need to do some work?
-        pending_work = 0
-        for j in range(len(self.osds)):
-            for i in range(self.osds[j].num_cores):
-                pending_work += len(self.osds[j].cores[i].tq)
-                if self.osds[j].cores[i].running != None:
-                    pending_work = pending_work + 1
-            pending_work = pending_work + len(self.tq) + len(self.pq)
+        # Does anybody still need to do some work?
+        pending_work = len(self.tq) + len(self.pq) + self.n_dispatched
 
         if pending_work == 0:
             self.logger.debug ("TERMINATED")
@@ -573,44 +782,110 @@ class ActiveFS(event.TimeoutEventHandler):
 
     def request_data_transfer(self, task):
         transfer_from = [ 0 for x in range(len(self.osds)) ]
-        transfer_list = [ task.osd ]    # first element is the destination
+        dst = self.destination(task)
+        transfer_list = [ dst ]         # first element is the destination
         self.logger.debug ('Task %s has %d input files' % \
                             (task.name, len(task.input)))
         for f in task.input:
-            if not f.is_replicated(task.osd):
-                self.logger.info ("Request file transfer: %s from AFE %d to %d (task: %s, size: %d)" % (f.name, f.location, task.osd, task.name, f.size))
+            if self.claim_prefetch(task, f):
+                self.logger.debug ("File %s was prefetched to AFE %d" % (f.name, dst))
+            elif not f.is_replicated(dst):
+                if self.config.dedup and (f, dst) in self.inflight:
+                    # the task waits for the transfer already requested
+                    self.logger.debug ("File %s is already on its way to AFE %d" % (f.name, dst))
+                    continue
+                self.logger.info ("Request file transfer: %s from AFE %d to %d (task: %s, size: %d)" % (f.name, f.location, dst, task.name, f.size))
                 transfer_from[f.location] += f.size
                 task.account_transfer(f)
-                self.num_transfers += 1
-                self.fq.append ((task, f))
-                e = event.TimeoutEvent ('filetransfreq', self.FILETRANSLATENCY, self)
-                desc = '{}-{}: transfer request to {}'. \
-                        format (task.name, f.name, task.osd) 
-                e.set_description (desc)
-                self.ev.register_event (e)
+                self.queue_transfer(f, dst, task.name)
             else:
                 self.logger.debug ("File %s is already on AFE %d" % (f.name, f.location))
 
+    def queue_transfer(self, f, dst, name):
+        """f has to be copied to AFE dst (for task name)"""
+        self.num_transfers += 1
+        self.inflight.add ((f, dst))
+        if self.config.multicast and f in self.queued:
+            # one more destination for a transfer not started yet
+            self.queued[f][1].append (dst)
+            return
+        entry = (f, [ dst ])
+        self.fq.append (entry)
+        if self.config.multicast:
+            self.queued[f] = entry
+        e = self.ev.alloc_event (event.TRANSFER_REQ,
+                                 self.FILETRANSLATENCY, self)
+        if self.ev.tracing:
+            e.set_description ('%s-%s: transfer request to %d',
+                               name, f.name, dst)
+        self.ev.register_event (e)
+
+    def claim_prefetch(self, task, f):
+        """Is f prefetched (or being prefetched) to the AFE of task for it?
+        The first task prepared on the AFE claims the prefetch.
+        """
+        dst = self.destination(task)
+        record = self.prefetched.get((f, dst))
+        if record == None or (record[0] != None and record[0] is not task):
+            return False
+        if record[2] != None and not f.is_replicated(dst):
+            # prefetched, but evicted since
+            del self.prefetched[(f, dst)]
+            return False
+        if record[0] == None:
+            record[0] = task
+            task.account_transfer(f)
+        return True
+
+    def prefetch_outputs(self, task):
+        """
+        The outputs of task are produced, start copying them to the AFEs of
+        their consumers which still miss other inputs (i.e. are not prepared
+        yet), within the prefetch depth and bandwidth budget.
+        """
+        for f in task.output:
+            for t in f.consumers:
+                if t.n_missing == 0 or t.osd < 0 or t.host == True:
+                    continue
+                if f.is_replicated(t.osd) or (f, t.osd) in self.inflight:
+                    continue
+                if (f, t.osd) in self.prefetched:
+                    continue
+                if self.n_prefetching >= self.config.prefetch:
+                    return
+                if self.config.prefetch_budget > 0 and \
+                   self.prefetch_bytes + f.size > self.config.prefetch_budget:
+                    continue
+                self.logger.info ("Prefetch %s from AFE %d to %d (task: %s, size: %d)" % (f.name, f.location, t.osd, t.name, f.size))
+                self.prefetched[(f, t.osd)] = [ None, None, None ]
+                self.n_prefetching += 1
+                self.prefetch_bytes += f.size
+                self.num_prefetches += 1
+                self.queue_transfer(f, t.osd, 'prefetch')
+
     def progress_file_transfers(self, evt):
         """
         File transfers are serialized. This function initiate a new file
         transfer (based on the queued file transfer requests) if there is no
         ongoing file transfer
         """
-        if self.ongoing_file_transfer == False:
+        if self.network != None:
+            self.start_flows()
+        elif self.ongoing_file_transfer == False:
             self.logger.debug ("No ongoing file transfer")
             if (len (self.fq) > 0):
                 self.ongoing_file_transfer = True
-                (t, f) = self.fq.pop (0)
+                (f, dsts) = self.pop_transfer_request()
                 #delay = 2.0 * (0.3 + float(f.size)*1.02 / self.config.netbw)
                 delay = self.iomod.get_transfer_cost (f)
                 #print "%s/%s - Transfer time: %f" % (t.name, f.name, delay)
-                e = event.TimeoutEvent('transfer', delay, self)
-                e.set_context((t, f, delay))
-                desc = 'Transfers {}({}) from {} to {} (time to transfer: {})'. \
-                        format(f.name, f.size, f.location, t.osd, delay)
-                self.logger.debug (desc)
-                e.set_description(desc)
+                e = self.ev.alloc_event(event.TRANSFER, delay, self)
+                e.set_context((f, dsts, delay))
+                if self.ev.tracing:
+                    e.set_description('Transfers %s(%s) from %s to %s '
+                                      '(time to transfer: %s)', f.name,
+                                      f.size, f.location, dsts, delay)
+                    self.logger.debug (e.get_description())
                 self.ev.register_event(e)
             else:
                 self.logger.debug ("No more pending file transfer request")
@@ -657,9 +932,6 @@ class ActiveFS(event.TimeoutEventHandler):
 #            print 'TEST (%s): %f vs. %f' % (task.name, delay, delay2)
 #            e = event.TimeoutEvent('transfer', delay, self)
 #
-#            if len(transfer_list) == 2: # single transfer, set source
-#                e.source = transfer_list[1].location
-#
 #            e.set_context(transfer_list)
 #            desc = '{}({}) transfers {}'. \
 #                    format(task.name, task.osd,
@@ -670,14 +942,67 @@ class ActiveFS(event.TimeoutEventHandler):
 #            self.ev.register_event(e)
 #
 
-    def handle_transfer_complete(self, e):
-        (task, f, time) = e.get_context()
+    def start_flows(self):
+        """
+        Every queued file transfer request becomes a flow of the network
+        model right away.
+        """
+        while len(self.fq) > 0:
+            (f, dsts) = self.pop_transfer_request()
+            cost = self.iomod.get_transfer_cost(f)
+            # flows are point to point, a multicast becomes several flows
+            for dst in dsts:
+                self.logger.debug ('Flow {}({}) from {} to {} (cost: {})'. \
+                                   format(f.name, f.size, f.location, dst,
+                                          cost))
+                self.network.start_flow(f.location, dst, cost, (f, [ dst ]))
+
+    def pop_transfer_request(self):
+        (f, dsts) = self.fq.pop(0)
+        if self.queued.get(f) is not None and self.queued[f][1] is dsts:
+            del self.queued[f]
+        for dst in dsts:
+            record = self.prefetched.get((f, dst))
+            if record != None and record[1] == None:
+                # the prefetch leaves the transfer queue
+                record[1] = self.ev.now()
+        return (f, dsts)
+
+    def flow_completed(self, flow):
+        (f, dsts) = flow.get_context()
+        self.handle_transfer_complete(f, dsts, self.ev.now() - flow.started)
+        self.advance()
+
+    def handle_transfer_complete(self, f, dsts, time):
+        """f is now replicated on all the destinations (more than one for a
+        multicast transfer, which reads the source only once)
+        """
         self.logger.info ("File %s has been transfered in %.6f seconds" % \
                            (f.name, time))
-        f.add_replica(task.osd)
-        """update the rw statistics"""
-        self.osds[task.osd].data_transfer_write(f.size)
+        for dst in dsts:
+            f.add_replica(dst)
+            record = self.prefetched.get((f, dst))
+            if record != None and record[2] == None:
+                record[2] = self.ev.now()
+                self.n_prefetching -= 1
+                self.prefetch_bytes -= f.size
+                if record[0] != None:
+                    # claimed on its way, the consumer is done with it
+                    del self.prefetched[(f, dst)]
+            if self.device(dst).cache != None:
+                for x in self.device(dst).cache.insert(f):
+                    self.logger.info ("Evicting replica of %s from AFE %d" % (x.name, dst))
+                    x.remove_replica(dst)
+            self.inflight.discard((f, dst))
+            for t in self.waiters.pop((f, dst), []):
+                t.n_replicas -= 1
+                if t.n_replicas == 0:
+                    self.runnable.append(t)
+            """update the rw statistics"""
+            self.device(dst).data_transfer_write(f.size)
+            self.device(dst).metrics.transfers_in += 1
         self.osds[f.location].data_transfer_read(f.size)
+        self.osds[f.location].metrics.transfers_out += 1
 
     def advance(self):
         self.handle_prepared_tasks()
@@ -686,23 +1011,29 @@ class ActiveFS(event.TimeoutEventHandler):
             return
 
     def handle_prepared_tasks(self):
-        #print "Critical section - start"
-        tasks = [ task for task in self.tq ]
-        sorted_tasks = sorted (tasks, key=lambda task: task.name)
-        for task in sorted_tasks:
-            #print "Checking task %s" % task.name
-            if task.is_prepared():
-                self.tq.remove (task)
-                self.pq.append (task)
-                self.scheduler.task_prepared (task)
-                if (task.host == False):
-                    self.request_data_transfer(task)
-                e = event.TimeoutEvent ('prepare', 0, self)
-                self.ev.register_event (e)
-                break
-            else:
-                self.logger.debug ("Task %s is not prepared yet" % task.name)
-        #print "Critical section - end"
+        if len(self.prepared) == 0:
+            return
+        if self.config.serial_prepare:
+            # The first prepared task (by name) moves to pq, as the emulator
+            self.dispatch_prepared_tasks([ heapq.heappop(self.prepared)[1] ])
+            e = self.ev.alloc_event (event.PREPARE, 0, self)
+            self.ev.register_event (e)
+        elif self.prepare_event == None:
+            # The prepared tasks are handed to the scheduler together, once
+            # the simultaneous events or the batching window are over
+            self.prepare_event = self.ev.alloc_event (event.PREPARE,
+                                        self.config.prepare_window, self)
+            self.ev.register_event (self.prepare_event)
+
+    def dispatch_prepared_tasks(self, batch):
+        """the prepared tasks of batch move to pq"""
+        for task in batch:
+            self.tq.remove (task)
+            self.pq.add (task)
+        self.scheduler.task_prepared (batch)
+        for task in batch:
+            self.request_data_transfer(task)
+            self.wait_for_replicas(task)
 
 #        """
 #        Some file transfers may have completed since the last execution of the
@@ -740,14 +1071,103 @@ class ActiveFS(event.TimeoutEventHandler):
 #                                       task.name)
 #                    self.request_data_transfer(task)
 
+    def wait_for_replicas(self, task):
+        """
+        Index the prepared task under every input file which is not yet
+        replicated on its AFE (or the host); handle_transfer_complete wakes
+        it up once the last one arrives.
+        """
+        task.n_replicas = 0
+        dst = self.destination(task)
+        if task.host == False:
+            # how long the prefetched inputs have been transferred for
+            # (not counting the time queued behind other transfers)
+            saved = 0.0
+            for f in task.input:
+                record = self.prefetched.get((f, task.osd))
+                if record != None and record[0] is task:
+                    end = record[2]
+                    if end == None:
+                        # still on its way, handle_transfer_complete
+                        # releases the record
+                        end = self.ev.now()
+                    else:
+                        del self.prefetched[(f, task.osd)]
+                    if record[1] != None:
+                        saved = max(saved, end - record[1])
+            self.prefetch_saved += saved
+            if self.osds[task.osd].cache != None:
+                # the replicas must stay until the task completes
+                for f in task.input:
+                    self.osds[task.osd].cache.pin(f)
+        for f in task.input:
+            if not f.is_replicated(dst):
+                self.waiters.setdefault((f, dst), []).append(task)
+                task.n_replicas += 1
+        if task.n_replicas == 0:
+            self.runnable.append(task)
+
+    def steal_for_idle_devices(self):
+        """
+        Every idle AFE takes the last queued task of the AFE with the
+        longest backlog, provided that transferring its missing inputs is
+        expected to take less (by the steal margin) than its wait there.
+        The stolen task goes back to pq until its inputs are replicated.
+        The backlog is the one of a core queue, or of the AFE queue for the
+        tasks waiting for a free core.
+        """
+        for thief in self.osds:
+            if not thief.is_idle():
+                continue
+            victim = None
+            wait = 0.0
+            for osd in self.osds:
+                for core in osd.cores:
+                    if len(core.tq) == 0:
+                        continue
+                    w = core.remaining_time() - core.tq[-1].runtime
+                    if w > wait:
+                        (victim, wait) = (core, w)
+                if len(osd.tq) > 0:
+                    # tasks waiting for a free core (native device schedulers)
+                    w = osd.get_qtime() - osd.tq[-1].runtime / osd.num_cores
+                    if w > wait:
+                        (victim, wait) = (osd, w)
+            if victim == None:
+                return
+            task = victim.tq[-1]
+            cost = 0.0
+            for f in task.input:
+                if not f.is_replicated(thief.id):
+                    cost += self.iomod.get_transfer_cost(f)
+            if cost + self.config.steal_margin >= wait:
+                continue
+            self.logger.info ("AFE %d steals task %s from AFE %d (wait %.3f, transfer %.3f)" % (thief.id, task.name, task.osd, wait, cost))
+            victim.tq.pop()
+            if victim is not self.osds[task.osd]:
+                victim.metrics.queue.update(self.ev.now(), len(victim.tq))
+            self.osds[task.osd].metrics.queue.add(self.ev.now(), -1)
+            self.osds[task.osd].work_queued(task, -1)
+            self.num_steals[1] += 1
+            if self.osds[task.osd].cache != None:
+                for f in task.input:
+                    self.osds[task.osd].cache.unpin(f)
+            task.osd = thief.id
+            self.n_dispatched -= 1
+            self.pq.add(task)
+            self.request_data_transfer(task)
+            self.wait_for_replicas(task)
+            self.handle_ready_tasks()
+
     def handle_ready_tasks(self):
-        ready = [ task for task in self.pq if task.is_ready() ]
+        ready = self.runnable
         self.logger.debug ("%d tasks are ready" % len(ready))
         if len(ready) > 0:
-            for task in self.pq[:]:
-                if task in ready:
-                    self.pq.remove(task)
+            self.runnable = []
+            for task in ready:
+                self.pq.remove(task)
 
+            self.n_dispatched += len(ready)
             sorted_ready = sorted (ready, key=lambda task: task.name)
             for task in sorted_ready:
                 if task.host == True:
@@ -757,18 +1177,24 @@ class ActiveFS(event.TimeoutEventHandler):
                     self.osds[task.osd].submit_task(task)
 
     def handle_timeout(self, e):
-        if self.config.eventlog:
+        if self.ev.tracing:
             self.logger.debug ('(%.3f, %.3f) --- %s [%s] %s' % \
                   (e.registered, e.timeout, self.get_name(),
-                   e.name, e.description))
+                   e.name, e.get_description()))
 
-        if e.name == 'transfer':
-            self.handle_transfer_complete(e)
+        if e.kind == event.TRANSFER:
+            (f, dsts, time) = e.get_context()
+            self.handle_transfer_complete(f, dsts, time)
             self.ongoing_file_transfer = False
             # A file transfer just completed, checking if more are required
             self.progress_file_transfers (e)
-        elif e.name == 'filetransfreq':
+        elif e.kind == event.TRANSFER_REQ:
             self.progress_file_transfers (e)
+        elif e.kind == event.PREPARE and self.prepare_event != None:
+            # all the prepared tasks (by name) go together
+            self.prepare_event = None
+            self.dispatch_prepared_tasks([ heapq.heappop(self.prepared)[1]
+                                   for i in range(len(self.prepared)) ])
         else:
             pass
 
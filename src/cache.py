@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict
+
+class EvictLRU:
+    """least recently used replicas first"""
+    def candidates(self, cache):
+        return list(cache.files.keys())
+
+class EvictLFU:
+    """least frequently used replicas first (ties: least recently used)"""
+    def candidates(self, cache):
+        files = list(cache.files.keys())
+        order = dict([ (f, i) for (i, f) in enumerate(files) ])
+        return sorted(files, key=lambda f: (cache.files[f], order[f]))
+
+class EvictDead:
+    """workflow-aware: replicas which no remaining task placed on the AFE
+    will read go first, then least recently used ones
+    """
+    def candidates(self, cache):
+        dead = []
+        alive = []
+        for f in cache.files.keys():
+            if any([ not t.done and t.osd == cache.osd for t in f.consumers ]):
+                alive += [ f ]
+            else:
+                dead += [ f ]
+        return dead + alive
+
+eviction_policies = {
+    'lru': EvictLRU,
+    'lfu': EvictLFU,
+    'dead': EvictDead,
+}
+
+class ReplicaCache:
+    """replicas stored on an AFE, bounded by capacity (bytes). The files
+    placed on the AFE are not part of the cache. A replica read by a task
+    queued or running on the AFE is pinned and never evicted, the cache may
+    thus temporarily exceed its capacity.
+    """
+    def __init__(self, osd, capacity, policy):
+        self.osd = osd
+        self.capacity = capacity
+        self.policy = eviction_policies[policy]()
+        self.used = 0
+        self.files = OrderedDict()  # file -> number of accesses, LRU first
+        self.pins = {}              # file -> number of tasks reading it
+        self.n_evicted = 0          # statistics (bytes)
+        self.evictions = 0          # (replicas)
+
+    def insert(self, f):
+        """returns the evicted files"""
+        if f not in self.files:
+            self.files[f] = 0
+            self.used += f.size
+        self.touch(f)
+        return self.evict()
+
+    def touch(self, f):
+        if f in self.files:
+            count = self.files.pop(f)
+            self.files[f] = count + 1
+
+    def pin(self, f):
+        self.pins[f] = self.pins.get(f, 0) + 1
+        self.touch(f)
+
+    def unpin(self, f):
+        self.pins[f] -= 1
+        if self.pins[f] == 0:
+            del self.pins[f]
+
+    def evict(self):
+        evicted = []
+        if self.used <= self.capacity:
+            return evicted
+        for f in self.policy.candidates(self):
+            if self.used <= self.capacity:
+                break
+            if f in self.pins:
+                continue
+            del self.files[f]
+            self.used -= f.size
+            self.n_evicted += f.size
+            self.evictions += 1
+            evicted += [ f ]
+        return evicted
@@ -11,7 +11,9 @@ class Cluster(event.EventSimulator):
         self.config = config
         self.servers = []
         self.clients = []
-        event.EventSimulator.__init__(self)
+        event.EventSimulator.__init__(self, config.eventqueue,
+                                     config.eventlog != '',
+                                     config.delta)
         #self.ev = ev
         self.num_hosts = self.config.nodes
         self.tq = []
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import random
+import argparse
+
+import event
+
+class BenchHandler(event.TimeoutEventHandler):
+    """classic 'hold' model: every handled event schedules a new one, so the
+    queue population stays constant during the measurement.
+    """
+    def __init__(self, ev, count, quantum):
+        self.ev = ev
+        self.count = count
+        self.quantum = quantum
+        self.handled = 0
+
+    def get_name(self):
+        return 'Bench'
+
+    def new_event(self):
+        delay = random.expovariate(1.0)
+        if self.quantum > 0:
+            # quantized delays produce batches of simultaneous events
+            delay = round(delay / self.quantum) * self.quantum
+        return self.ev.alloc_event(event.TASK, delay, self)
+
+    def handle_timeout(self, e):
+        self.handled += 1
+        if self.handled < self.count:
+            self.ev.register_event(self.new_event())
+
+
+def bench(queue, population, count, quantum, seed):
+    random.seed(seed)
+    ev = event.EventSimulator(queue)
+    handler = BenchHandler(ev, count, quantum)
+    for i in range(population):
+        ev.register_event(handler.new_event())
+
+    start = time.time()
+    finish = ev.run()
+    elapsed = time.time() - start
+
+    return handler.handled, elapsed, finish
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                description='event queue micro-benchmark (events/sec)')
+    parser.add_argument('-p', '--population', type=int, default=10000,
+                        help='number of pending events')
+    parser.add_argument('-n', '--count', type=int, default=200000,
+                        help='number of events to process')
+    parser.add_argument('-t', '--quantum', type=float, default=0.01,
+                        help='timestamp granularity (0 for continuous)')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='random seed')
+    parser.add_argument('-q', '--eventqueue', type=str, action='append',
+                        choices=sorted(event.event_queues.keys()),
+                        help='backend to measure (default all)')
+    args = parser.parse_args()
+
+    queues = args.eventqueue
+    if queues == None:
+        queues = sorted(event.event_queues.keys())
+
+    print '%-10s%12s%12s%14s%12s' % \
+            ('queue', 'events', 'seconds', 'events/sec', 'finish')
+    for queue in queues:
+        (handled, elapsed, finish) = bench(queue, args.population,
+                                           args.count, args.quantum,
+                                           args.seed)
+        print '%-10s%12d%12.3f%14.0f%12.3f' % \
+                (queue, handled, elapsed, handled / elapsed, finish)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,20 +1,39 @@
 #!/usr/bin/env python
 
+import os
+import sys
+import time
 import heapq
+import bisect
 
-class TimeoutEvent:
+"""event kinds, handlers dispatch on these instead of comparing names
+"""
+(INIT, EXIT, IDLE, TASK, PREPARE, TRANSFER_REQ, TRANSFER, FLOW,
+ FLASH) = range(9)
+kind_names = [ 'init', 'exit', 'idle', 'task', 'prepare', 'filetransfreq',
+               'transfer', 'flow', 'flash' ]
+
+class TimeoutEvent(object):
     """descriptiont of an event
     """
-    def __init__(self, name, timeout, handler):
-        self.name = name
+    __slots__ = ('kind', 'registered', 'timeout', 'handler', 'context',
+                 'description', 'desc_args', 'disposable', 'handle', 'pooled')
+
+    def __init__(self, kind, timeout, handler):
+        self.kind = kind
         self.registered = 0.0
         self.timeout = timeout
         self.handler = handler
         self.context = None
         self.description = None
+        self.desc_args = None
         self.disposable = False
-        # Ugly: This should be enhanced
-        self.source = -1
+        self.handle = None      # set while the event is pending
+        self.pooled = False     # recycled by the simulator once handled
+
+    @property
+    def name(self):
+        return kind_names[self.kind]
 
     def __lt__(self, other):
         return self.timeout < other.timeout
@@ -22,6 +41,9 @@ class TimeoutEvent:
     def set_disposable(self):
         self.disposable = True
 
+    def is_pending(self):
+        return self.handle is not None
+
     def set_timeout(self, timeout):
         self.timeout = timeout
 
@@ -31,10 +53,15 @@ class TimeoutEvent:
     def get_context(self):
         return self.context
 
-    def set_description(self, desc):
+    def set_description(self, desc, *args):
+        """the description is only formatted (with args) when requested
+        """
         self.description = desc
+        self.desc_args = args
 
     def get_description(self):
+        if self.desc_args:
+            return self.description % self.desc_args
         return self.description
 
     def execute_handler(self):
@@ -54,14 +81,388 @@ class TimeoutEventHandler:
         pass
 
 
+class EventHandle(object):
+    """handle of a registered event, returned by register_event(). Cancelling
+    an event only drops the reference (tombstone), the queue skips the dead
+    handle when it reaches it (lazy deletion).
+    """
+    __slots__ = ('timeout', 'event')
+
+    def __init__(self, event):
+        self.timeout = event.timeout
+        self.event = event
+        event.handle = self
+
+    def __lt__(self, other):
+        return self.timeout < other.timeout
+
+    def is_cancelled(self):
+        return self.event is None
+
+    def cancel(self):
+        self.event.handle = None
+        self.event = None
+
+
+class EventQueue:
+    """base of the event queues. With delta cycles, the events registered for
+    the current time (zero delay) are kept in a plain FIFO list and handed
+    back as the next batch, without going through the queue at all. This is
+    the same batch the queue would return, but in registration order: the
+    heap returns simultaneous events in no particular order, so the results
+    may differ. Delta cycles are thus off by default.
+    """
+    def __init__(self, delta=False):
+        self.size = 0           # number of live (not cancelled) events
+        self.last = 0.0         # timestamp of the last dequeued batch
+        self.delta = None
+        if delta:
+            self.delta = []
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for h in self.handles():
+            if h.event is not None:
+                yield h.event
+
+    def handles(self):
+        if self.delta:
+            for h in self.delta:
+                yield h
+        for h in self.queued():
+            yield h
+
+    def push(self, event):
+        h = EventHandle(event)
+        self.size += 1
+        if self.delta is not None and h.timeout == self.last:
+            self.delta.append(h)
+        else:
+            self.insert(h)
+        return h
+
+    def pop_batch(self):
+        handles = None
+        if self.delta:
+            handles = [ h for h in self.delta if h.event is not None ]
+            self.delta = []
+        if not handles:
+            handles = self.remove_next()
+            self.last = handles[0].timeout
+
+        events = [ h.event for h in handles ]
+        for h in handles:
+            h.cancel()
+        self.size -= len(events)
+        return events
+
+    def peek(self):
+        """timestamp of the next live event
+        """
+        if self.delta:
+            for h in self.delta:
+                if h.event is not None:
+                    return self.last
+        return self.next_timestamp()
+
+    def cancel(self, h):
+        h.cancel()
+        self.size -= 1
+
+    def discard(self, pred):
+        for h in list(self.handles()):
+            if h.event is not None and pred(h.event):
+                self.cancel(h)
+
+
+class HeapEventQueue(EventQueue):
+    """binary heap of events, simultaneous events are gathered by popping
+    until the first event with a different timestamp (which is pushed back)
+    """
+    def __init__(self, delta=False):
+        EventQueue.__init__(self, delta)
+        self.heap = []
+
+    def queued(self):
+        return self.heap
+
+    def insert(self, h):
+        heapq.heappush(self.heap, h)
+
+    def remove_next(self):
+        h = heapq.heappop(self.heap)
+        while h.event is None:
+            h = heapq.heappop(self.heap)
+        handles = [ h ]
+
+        while len(self.heap) > 0:     # pop others with same timestamp
+            next_h = heapq.heappop(self.heap)
+            if next_h.event is None:
+                continue
+            if next_h.timeout == h.timeout:
+                handles += [ next_h ]
+            else:
+                heapq.heappush(self.heap, next_h)
+                break
+
+        return handles
+
+    def next_timestamp(self):
+        while self.heap[0].event is None:
+            heapq.heappop(self.heap)
+        return self.heap[0].timeout
+
+    def cancel(self, h):
+        EventQueue.cancel(self, h)
+        # too many tombstones, get rid of them
+        if len(self.heap) > 2 * self.size + 64:
+            self.heap = [ x for x in self.heap if x.event is not None ]
+            heapq.heapify(self.heap)
+
+
+class CalendarEventQueue(EventQueue):
+    """calendar queue (R. Brown, CACM'88) over distinct timestamps.
+
+    Every distinct timestamp owns a FIFO list of events, so all simultaneous
+    events are handed back at once. The timestamps themselves are hashed into
+    'days' of a year of nbuckets x width seconds, each day being a short
+    sorted list. The calendar is resized (and the day width re-estimated)
+    whenever the number of distinct timestamps doubles or halves. As in the
+    dynamic calendar queue (Oh & Ahn, 1997), the day width is also
+    re-estimated when the dequeues scan too many empty days, from the
+    separation of the dequeued timestamps, so that a stale width does not
+    turn every pop into a search.
+    """
+    SAMPLES = 25
+    SCAN = 4            # empty days scanned per dequeue, on average
+
+    def __init__(self, delta=False, nbuckets=2, width=1.0):
+        EventQueue.__init__(self, delta)
+        self.stamps = {}        # timestamp -> [ handles ]
+        self.resize(nbuckets, width)
+
+    def queued(self):
+        for handles in self.stamps.values():
+            for h in handles:
+                yield h
+
+    def day(self, ts):
+        return int(ts / self.width)
+
+    def resize(self, nbuckets, width):
+        self.nbuckets = nbuckets
+        self.width = width
+        self.buckets = [ [] for i in range(nbuckets) ]
+        for ts in self.stamps:
+            bisect.insort(self.buckets[self.day(ts) % nbuckets], ts)
+        self.top = nbuckets * 2
+        self.bottom = nbuckets // 2 - 2
+        self.popped = 0         # timestamps dequeued since the resize
+        self.first = 0.0        # the first of them
+        self.scanned = 0        # empty days scanned meanwhile
+
+    def estimate_width(self):
+        """three times the average separation of the timestamps dequeued
+        since the last resize, or else of the earliest timestamps (ignoring
+        separations larger than twice the average)
+        """
+        if self.popped > self.SAMPLES and self.last > self.first:
+            return 3.0 * (self.last - self.first) / (self.popped - 1)
+        stamps = heapq.nsmallest(self.SAMPLES, self.stamps)
+        gaps = [ y - x for (x, y) in zip(stamps, stamps[1:]) ]
+        if len(gaps) == 0:
+            return self.width
+        avg = sum(gaps) / len(gaps)
+        gaps = [ g for g in gaps if g <= 2.0 * avg ]
+        avg = sum(gaps) / len(gaps)
+        if avg <= 0.0:
+            return self.width
+        return 3.0 * avg
+
+    def insert(self, h):
+        handles = self.stamps.get(h.timeout)
+        if handles is not None:
+            handles.append(h)
+            return
+
+        self.stamps[h.timeout] = [ h ]
+        bisect.insort(self.buckets[self.day(h.timeout) % self.nbuckets],
+                      h.timeout)
+        if len(self.stamps) > self.top:
+            self.resize(self.nbuckets * 2, self.estimate_width())
+
+    def next_bucket(self):
+        start = self.day(self.last)
+        end = start + self.nbuckets
+        day = start
+        while day < end:
+            bucket = self.buckets[day % self.nbuckets]
+            if len(bucket) > 0 and self.day(bucket[0]) <= day:
+                self.scanned += day - start
+                return bucket
+            day += 1
+        # nothing in this year, directly search for the minimum
+        self.scanned += self.nbuckets
+        return min([ b for b in self.buckets if len(b) > 0 ])
+
+    def pop_stamp(self):
+        ts = self.next_bucket().pop(0)
+
+        if self.popped == 0:
+            self.first = ts
+        self.popped += 1
+        self.last = ts
+        handles = self.stamps.pop(ts)
+        if len(self.stamps) < self.bottom:
+            self.resize(self.nbuckets // 2, self.estimate_width())
+        elif self.popped > self.SAMPLES and \
+             self.scanned > self.SCAN * self.popped:
+            # the day width went stale
+            self.resize(self.nbuckets, self.estimate_width())
+        return handles
+
+    def remove_next(self):
+        while True:     # skip timestamps with only tombstones
+            handles = [ h for h in self.pop_stamp() if h.event is not None ]
+            if len(handles) > 0:
+                return handles
+
+    def next_timestamp(self):
+        while True:
+            ts = self.next_bucket()[0]
+            for h in self.stamps[ts]:
+                if h.event is not None:
+                    return ts
+            self.pop_stamp()
+
+
+event_queues = { 'heap': HeapEventQueue,
+                 'calendar': CalendarEventQueue }
+
+
+class EventProfile:
+    """event loop instrumentation. It is only installed on demand (see
+    EventSimulator.enable_profiling), so it costs nothing otherwise. Handler
+    times are inclusive (e.g. the scheduler calls made by a handler).
+    """
+    def __init__(self, interval):
+        self.interval = interval    # queue depth sampled every n batches
+        self.handlers = {}          # handler class -> [ count, seconds ]
+        self.kinds = {}             # event name -> [ count, seconds ]
+        self.calls = {}             # wrapped calls -> [ count, seconds ]
+        self.events = 0
+        self.batches = 0
+        self.max_batch = 0
+        self.queue_time = 0.0       # spent in pop_batch
+        self.wall = 0.0             # spent in the event loop
+        self.depth = []             # (simulated time, queue depth)
+        self.gauges = {}            # name -> [ function, samples ]
+
+    def add_gauge(self, name, function):
+        """sample function() along with the queue depth, as (simulated time,
+        value)
+        """
+        self.gauges[name] = [ function, [] ]
+
+    def account(self, table, key, elapsed):
+        entry = table.get(key)
+        if entry is None:
+            table[key] = [ 1, elapsed ]
+        else:
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def wrap(self, obj, name):
+        """proxy timing every method call made through it
+        """
+        return ProfiledProxy(self, obj, name)
+
+    def summary(self):
+        def table(t):
+            return dict([ (k, { 'count': v[0], 'seconds': v[1] })
+                          for (k, v) in t.items() ])
+        rate = 0.0
+        if self.wall > 0:
+            rate = self.events / self.wall
+        return { 'events': self.events,
+                 'batches': self.batches,
+                 'max_batch': self.max_batch,
+                 'wall_seconds': self.wall,
+                 'events_per_sec': rate,
+                 'queue_seconds': self.queue_time,
+                 'handlers': table(self.handlers),
+                 'event_kinds': table(self.kinds),
+                 'calls': table(self.calls),
+                 'queue_depth': self.depth,
+                 'gauges': dict([ (k, v[1])
+                                  for (k, v) in self.gauges.items() ]) }
+
+
+class ProfiledProxy(object):
+    def __init__(self, profile, obj, name):
+        self.__dict__['_profile'] = profile
+        self.__dict__['_obj'] = obj
+        self.__dict__['_name'] = name
+
+    def __getattr__(self, attr):
+        value = getattr(self._obj, attr)
+        if not callable(value):
+            return value
+        profile = self._profile
+        key = '%s.%s' % (self._name, attr)
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return value(*args, **kwargs)
+            finally:
+                profile.account(profile.calls, key, time.time() - start)
+        return timed
+
+    def __setattr__(self, attr, value):
+        setattr(self._obj, attr, value)
+
+
 class EventSimulator:
     """discrete event simulation
     """
-    def __init__(self):
-        self.eq = []         # heap
+    def __init__(self, queue='heap', tracing=False, delta=False):
+        self.eq = event_queues[queue](delta)
         self.current = 0.0   # current time
         self.modules = []
         self.terminated = False
+        self.tracing = tracing  # build event descriptions?
+        self.pool = []       # free list of pooled events
+        self.profile = None
+
+    def enable_profiling(self, interval=100):
+        """replace the event loop step by an instrumented one
+        """
+        self.profile = EventProfile(interval)
+        self.step = self.profiled_step
+        return self.profile
+
+    def alloc_event(self, kind, timeout, handler):
+        """one-shot event taken from the free list; it is given back to the
+        pool once handled, so the caller must not keep any reference to it
+        """
+        if len(self.pool) > 0:
+            e = self.pool.pop()
+            e.kind = kind
+            e.timeout = timeout
+            e.handler = handler
+        else:
+            e = TimeoutEvent(kind, timeout, handler)
+            e.pooled = True
+        return e
+
+    def free_event(self, e):
+        e.context = None
+        e.description = None
+        e.desc_args = None
+        e.disposable = False
+        self.pool.append(e)
 
     def register_module(self, module):
         self.modules += [ module ]
@@ -69,61 +470,98 @@ class EventSimulator:
     def register_event(self, event):
         event.registered = self.current
         event.timeout += self.current
-        heapq.heappush(self.eq, event)
+        return self.eq.push(event)
+
+    def cancel_event(self, handle):
+        """cancel a pending event, either from its handle or the event itself.
+        Returns False if the event was not pending anymore.
+        """
+        if isinstance(handle, TimeoutEvent):
+            handle = handle.handle
+        if handle is None or handle.is_cancelled():
+            return False
+        self.eq.cancel(handle)
+        return True
+
+    def reschedule_event(self, event, timeout):
+        """(re)register an event to fire after timeout, cancelling the pending
+        instance if any
+        """
+        self.cancel_event(event)
+        event.set_timeout(timeout)
+        return self.register_event(event)
 
     def prepare(self):
         for module in self.modules:
-            self.register_event(TimeoutEvent('init', 0, module))
+            self.register_event(TimeoutEvent(INIT, 0, module))
 
     def terminate(self):
         if not self.terminated:
             self.terminated = True
             for module in self.modules:
-                self.register_event(TimeoutEvent('exit', 0, module))
-            li = [ x for x in self.eq if x.disposable ]
-            for e in self.eq[:]:
-                if e in li:
-                    self.eq.remove(e)
+                self.register_event(TimeoutEvent(EXIT, 0, module))
+            self.eq.discard(lambda x: x.disposable)
 
     def now(self):
         return self.current
 
-    def run(self):
-        while len(self.eq) > 0:
-            if (len(self.eq) <= 0):
-                continue;
-
-            e = heapq.heappop(self.eq)
-            self.current = e.timeout
-            events = [ e ]
-
-            while len(self.eq) > 0:     # pop others with same timestamp
-                next_event = heapq.heappop(self.eq)
-                if next_event.timeout == self.current:
-                    events += [ next_event ]
-                else:
-                    heapq.heappush(self.eq, next_event)
-                    break
-
-            events_bcast = [ e for e in events if e.source >= 0 ]
-            if len(events_bcast) > 0:
-                sources = list(set(map(lambda x: x.source, events_bcast)))
-                for s in sources:
-                    es = [ e for e in events if e.source == s ]
-                    shared = len(es)
-                    if shared > 1:
-                        for e in es:
-                            e.timeout += shared * (e.timeout - e.registered)
-                            e.source = -1   # no more adjustment
-                            heapq.heappush(self.eq, e)
-                        events = list(set(events) - set(es))
-
-            if len(events) == 0:
-                continue
+    def fork(self):
+        """fork the simulation, the child process continues from the very
+        same state (copy-on-write). Returns the child pid in the parent and 0
+        in the child.
+        """
+        sys.stdout.flush()
+        sys.stderr.flush()
+        return os.fork()
+
+    def step(self):
+        """process the next batch of simultaneous events
+        """
+        events = self.eq.pop_batch()
+        self.current = events[0].timeout
+
+        for e in events:
+            if not self.terminated:
+                e.execute_handler()
+            if e.pooled and e.handle is None:
+                self.free_event(e)
+
+    def profiled_step(self):
+        p = self.profile
+        start = time.time()
+        events = self.eq.pop_batch()
+        p.queue_time += time.time() - start
+        self.current = events[0].timeout
 
-            for e in events:
-                if not self.terminated:
-                    e.execute_handler()
+        p.batches += 1
+        p.events += len(events)
+        p.max_batch = max(p.max_batch, len(events))
+        if p.batches % p.interval == 0:
+            p.depth.append((self.current, len(self.eq)))
+            for (function, samples) in p.gauges.values():
+                samples.append((self.current, function()))
+
+        for e in events:
+            handler = e.handler.__class__.__name__
+            name = e.name
+            t = time.time()
+            if not self.terminated:
+                e.execute_handler()
+            elapsed = time.time() - t
+            p.account(p.handlers, handler, elapsed)
+            p.account(p.kinds, name, elapsed)
+            if e.pooled and e.handle is None:
+                self.free_event(e)
+
+        p.wall += time.time() - start
+
+    def run(self, until=None):
+        """process the events, only up to the time 'until' if given
+        """
+        while len(self.eq) > 0:
+            if until != None and self.eq.peek() > until:
+                break
+            self.step()
 
         return self.current
 
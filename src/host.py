@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 from itertools import *
-from functools import reduce
 import activefs
 import event
 import scipy
@@ -61,17 +60,12 @@ class Server(event.TimeoutEventHandler):
         print '\nOSD busy intervals'
         busy = []
         for i in range(len(self.afs.osds)):
-            intervals = [ (t.stat.t_start, t.stat.t_complete)
-                          for t in self.afs.job.tasks.values() if t.osd == i]
-            if len(intervals) > 0:
-                busy += [ reduce(lambda x, y: x+y,
-                                 map(lambda (x, y): y-x, intervals)) ]
-            else:
-                busy += [ 0.0 ]
+            m = self.afs.osds[i].metrics
+            busy += [ m.busy ]
             print 'OSD %d: %.3f sec\n\t[%s]' % \
                     (i, busy[-1],
                      ', '.join('(%.2f, %.2f)' % (x,y) for x,y in
-                             sorted(intervals, key=lambda x: x[0])))
+                             sorted(m.intervals, key=lambda x: x[0])))
 
         util_mean = scipy.mean(busy) / self.afs.ev.current * 100
         util_std = scipy.std(busy) / self.afs.ev.current * 100
@@ -79,11 +73,36 @@ class Server(event.TimeoutEventHandler):
         print '\nOSD mean utilization = %.3f' % util_mean
         print 'OSD std utilization = %.3f' % util_std
 
+        print '\nAFE queue statistics'
+        print '%-3s%8s%12s%10s%10s' % \
+                ('OSD', 'Tasks', 'Mean queue', 'Xfer in', 'Xfer out')
+        for osd in self.afs.osds:
+            m = osd.metrics
+            print '%3d%8d%12.3f%10d%10d' % \
+                    (osd.id, m.get_tasks(), m.queue.mean(self.afs.ev.current),
+                     m.transfers_in, m.transfers_out)
+            if osd.num_cores > 1:
+                print '\tcore busy: [%s]' % \
+                        ', '.join('%.2f' % c.metrics.busy for c in osd.cores)
+        if self.afs.host != None:
+            m = self.afs.host.metrics
+            print 'Host: %d tasks, %.3f sec busy, mean queue %.3f, ' \
+                  '%d transfers in' % \
+                    (m.get_tasks(), m.busy, m.queue.mean(self.afs.ev.current),
+                     m.transfers_in)
+            print '\tcore busy: [%s]' % \
+                    ', '.join('%.2f' % c.metrics.busy
+                              for c in self.afs.host.cores)
+
         """SSD statistics
         """
         print '\nSSD RW statistics'
+        evictions = self.afs.config.cache_size > 0
         print '%-3s%11s%11s%11s%11s' % \
-                ('OSD', 'Total R', 'Total W', 'Extra R', 'Extra W')
+                ('OSD', 'Total R', 'Total W', 'Extra R', 'Extra W'),
+        if evictions:
+            print '%11s%10s' % ('Evicted', 'Replicas'),
+        print
         total_read = 0
         total_write = 0
         for i in range(len(self.afs.osds)):
@@ -93,10 +112,13 @@ class Server(event.TimeoutEventHandler):
             extra_write = self.afs.osds[i].get_extra_write()
             print repr(i).rjust(3),
             print repr(total_read).rjust(10), repr(total_write).rjust(10),
-            print repr(extra_read).rjust(10), repr(extra_write).rjust(10)
+            print repr(extra_read).rjust(10), repr(extra_write).rjust(10),
+            if evictions:
+                print repr(self.afs.osds[i].get_evicted()).rjust(10),
+                print repr(self.afs.osds[i].get_evictions()).rjust(9),
+            print
 
-        total_transfer = reduce(lambda x, y: x+y,
-                           [ osd.get_extra_read() for osd in self.afs.osds ])
+        total_transfer = sum([ osd.get_extra_read() for osd in self.afs.osds ])
         reads = map(lambda x: x.get_total_read(), self.afs.osds)
         writes = map(lambda x: x.get_total_write(), self.afs.osds)
 
@@ -109,6 +131,9 @@ class Server(event.TimeoutEventHandler):
 
         print '\nTotal data transfer = %d bytes (%.3f MB)' % \
                     (total_transfer, float(total_transfer) / (2**20))
+        if self.afs.network != None:
+            print 'Network flows: %d (at most %d at once)' % \
+                    (self.afs.network.n_flows, self.afs.network.max_active)
         print 'SSD mean read = %d bytes (%.3f MB)' % \
                     (rmean, float(rmean) / (2**20))
         print 'SSD mean write = %d bytes (%.3f MB)' % \
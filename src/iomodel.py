@@ -1,5 +1,11 @@
 #!/usr/bin/env python
 
+import event
+
+# internal bandwidth of an SSD (iSSD, ICS'11)
+SSD_CHANNELS = 32
+SSD_CHANNEL_BW = 40 * (1 << 20)
+
 class EmulatorIOModel:
     def __init__(self, config):
         self.config = config
@@ -8,8 +14,11 @@ class EmulatorIOModel:
         self.SMALLFILEOVERHEAD = 0
 
     def get_transfer_cost(self, f):
-        if f.size > 1000000:
-            transfer_time = float(f.size) / self.config.netbw
+        return self.get_size_cost(f.size)
+
+    def get_size_cost(self, size):
+        if size > 1000000:
+            transfer_time = float(size) / self.config.netbw
         else:
             transfer_time = self.SMALLFILEOVERHEAD
         return transfer_time
@@ -19,7 +28,10 @@ class DefaultIOModel:
         self.config = config
 
     def get_transfer_cost(self, f):
-        return 2.0 * (0.3 + float(f.size) * 1.02 / self.config.netbw)
+        return self.get_size_cost(f.size)
+
+    def get_size_cost(self, size):
+        return 2.0 * (0.3 + float(size) * 1.02 / self.config.netbw)
 
 class IOModel:
     def __init__(self, config, module_name):
@@ -33,3 +45,66 @@ class IOModel:
 
     def get_transfer_cost(self, afile):
         return self.module.get_transfer_cost(afile)
+
+    """cost of transferring size bytes, e.g. for a file not created yet
+    """
+    def get_size_cost(self, size):
+        return self.module.get_size_cost(size)
+
+
+class FlashChannels(event.TimeoutEventHandler):
+    """internal flash channels of an AFE. A task first reads its inputs and
+    writes its outputs, then computes; the uncontended IO time is the part of
+    its runtime given by the internal bandwidth. The IO phases of the tasks
+    running on the cores share the channels equally, so they stretch when
+    several cores do IO at the same time.
+    """
+    def __init__(self, ev, channels, channel_bw):
+        self.ev = ev
+        self.bw = float(channels * channel_bw)
+        self.active = {}        # core -> [ remaining bytes, compute, event ]
+        self.updated = 0.0
+        self.ev.register_module(self)
+
+    def get_name(self):
+        return 'Flash'
+
+    def progress(self):
+        now = self.ev.now()
+        if len(self.active) > 0:
+            done = (now - self.updated) * self.bw / len(self.active)
+            for io in self.active.values():
+                io[0] = max(io[0] - done, 0.0)
+        self.updated = now
+
+    def reschedule(self):
+        rate = self.bw / max(len(self.active), 1)
+        for io in self.active.values():
+            self.ev.reschedule_event(io[2], io[0] / rate)
+
+    def start_io(self, core, task, runtime):
+        """the core calls back io_done(task, compute) at the end of the IO
+        phase
+        """
+        nbytes = task.input_bytes + task.output_bytes
+        compute = max(runtime - nbytes / self.bw, 0.0)
+        if nbytes == 0:
+            core.io_done(task, compute)
+            return
+        self.progress()
+        e = self.ev.alloc_event(event.FLASH, 0, self)
+        e.set_context(core)
+        self.active[core] = [ float(nbytes), compute, e ]
+        self.reschedule()
+
+    def handle_timeout(self, e):
+        if e.kind != event.FLASH:
+            return
+
+        core = e.get_context()
+        self.progress()
+        # an IO phase ending at the same time may have rescheduled us already
+        self.ev.cancel_event(e)
+        io = self.active.pop(core)
+        self.reschedule()
+        core.io_done(core.running, io[1])
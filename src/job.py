@@ -19,29 +19,49 @@ class DataFile:
             raise
         else:
             self.producer = None
+            self.consumers = []
             self.ready = False
             if self.size > 0:
                 self.ready = True
-            self.replica = []
+            self.replica = set()
 
     def set_location(self, osd):
         self.location = osd
 
     def add_replica(self, osd):
-        self.replica += [ osd ]
+        self.replica.add(osd)
+
+    def remove_replica(self, osd):
+        self.replica.discard(osd)
 
     def set_producer(self, task):
         self.producer = task
 
+    def add_consumer(self, task):
+        self.consumers += [ task ]
+
     def is_replicated(self, osd):
         return self.location == osd or osd in self.replica
 
     def is_ready(self):
         return self.size > 0 and self.location >= 0
 
+    def produced(self):
+        """The file is created, returns the consumers which now have all
+        their input files (see ActiveTask.n_missing)
+        """
+        prepared = []
+        if self.size < 0:
+            self.size = -self.size
+            for task in self.consumers:
+                task.n_missing -= 1
+                if task.n_missing == 0:
+                    prepared += [ task ]
+        return prepared
+
     def make_ready(self, osd):
-        self.size = abs(self.size)
         self.location = osd
+        return self.produced()
 
 
 class ActiveTaskStat:
@@ -86,11 +106,22 @@ class ActiveTask:
             self.output = [ files[x] for x in obj['output'] ]
             for f in self.output:
                 f.set_producer(self)
+            for f in self.input:
+                f.add_consumer(self)
         except:
             raise
         else:
+            # bytes read and written (sizes are negative until produced)
+            self.input_bytes = sum([ abs(f.size) for f in self.input ])
+            self.output_bytes = sum([ abs(f.size) for f in self.output ])
+            # number of input files which are not created yet
+            self.n_missing = len([ f for f in self.input if f.size < 0 ])
+            # number of input files not replicated yet on the AFE, once
+            # prepared (see ActiveFS.wait_for_replicas)
+            self.n_replicas = 0
             self.osd = -1
             self.host = False
+            self.done = False
             self.stat = ActiveTaskStat()
 
     def set_osd(self, osd):
@@ -105,19 +136,20 @@ class ActiveTask:
     def started(self, now):
         self.stat.started(now)
 
+    """returns the tasks which got all their input files with this one
+    """
     def completed(self, now):
         self.stat.completed(now)
+        prepared = []
         for f in self.output:
-            f.make_ready(self.osd)
+            prepared += f.make_ready(self.osd)
+        return prepared
 
     def account_transfer(self, f):
         self.stat.f_transfers += [ f ]
 
     def is_prepared(self):
-        for f in self.input:
-            if f.size < 0:
-                return False
-        return True
+        return self.n_missing == 0
 
     def is_ready(self):
         if self.is_prepared() == False:
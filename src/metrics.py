@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+class TimeAverage:
+    """time-weighted average of a value (e.g. a queue length), updated
+    whenever the value changes
+    """
+    def __init__(self):
+        self.value = 0
+        self.area = 0.0
+        self.since = 0.0
+
+    def update(self, now, value):
+        self.area += self.value * (now - self.since)
+        self.value = value
+        self.since = now
+
+    def add(self, now, delta):
+        self.update(now, self.value + delta)
+
+    def mean(self, now):
+        if now <= 0.0:
+            return 0.0
+        return (self.area + self.value * (now - self.since)) / now
+
+class DeviceMetrics:
+    """online statistics of an AFE or a core, maintained as the events
+    happen so that reporting does not scan the tasks
+    """
+    def __init__(self):
+        self.busy = 0.0
+        self.intervals = []     # (start, completion) of the executed tasks
+        self.queue = TimeAverage()
+        self.transfers_in = 0
+        self.transfers_out = 0
+
+    def task_completed(self, task):
+        self.busy += task.stat.t_complete - task.stat.t_start
+        self.intervals.append((task.stat.t_start, task.stat.t_complete))
+
+    def get_tasks(self):
+        return len(self.intervals)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+import event
+
+class Flow:
+    """a file transfer in progress between two AFEs. The amount of work is
+    expressed in seconds at the full link rate (i.e. the transfer cost given
+    by the IO model), the rate is the fraction of the link we currently get.
+    """
+    def __init__(self, id, src, dst, cost, context):
+        self.id = id
+        self.src = src
+        self.dst = dst
+        self.cost = cost
+        self.remaining = cost
+        self.rate = 0.0
+        self.started = 0.0
+        self.updated = 0.0      # when remaining was last brought up to date
+        self.context = context
+        self.event = None
+
+    def get_context(self):
+        return self.context
+
+    def progress(self, now):
+        self.remaining -= (now - self.updated) * self.rate
+        if self.remaining < 0.0:
+            self.remaining = 0.0
+        self.updated = now
+
+
+class FlowNetwork(event.TimeoutEventHandler):
+    """flow-level network model. Every AFE has an outgoing and an incoming
+    link of the same capacity; concurrent flows share the links with max-min
+    fairness (progressive filling). The rates are only recomputed for the
+    flows which (transitively) share a link with a starting or ending flow,
+    and only the flows whose rate changed get their completion rescheduled.
+    """
+    def __init__(self, ev, afs):
+        self.ev = ev
+        self.afs = afs
+        self.next_id = 0
+        self.egress = {}        # osd -> { flow id: flow }
+        self.ingress = {}
+        self.n_flows = 0        # statistics
+        self.max_active = 0
+        self.ev.register_module(self)
+
+    def get_name(self):
+        return 'FlowNetwork'
+
+    def get_active(self):
+        return sum([ len(x) for x in self.egress.values() ])
+
+    def start_flow(self, src, dst, cost, context):
+        flow = Flow(self.next_id, src, dst, cost, context)
+        self.next_id += 1
+        self.n_flows += 1
+        flow.started = flow.updated = self.ev.now()
+        flow.event = self.ev.alloc_event(event.FLOW, 0, self)
+        flow.event.set_context(flow)
+        self.egress.setdefault(src, {})[flow.id] = flow
+        self.ingress.setdefault(dst, {})[flow.id] = flow
+        self.max_active = max(self.max_active, self.get_active())
+        self.rebalance(src, dst)
+        return flow
+
+    def component(self, src, dst):
+        """flows sharing a link, directly or not, with the given links
+        """
+        flows = {}
+        links = [ (self.egress, src), (self.ingress, dst) ]
+        seen = set([ (id(self.egress), src), (id(self.ingress), dst) ])
+        while len(links) > 0:
+            (table, osd) = links.pop()
+            for flow in table.get(osd, {}).values():
+                if flow.id in flows:
+                    continue
+                flows[flow.id] = flow
+                for (t, o) in [ (self.egress, flow.src),
+                                (self.ingress, flow.dst) ]:
+                    if (id(t), o) not in seen:
+                        seen.add((id(t), o))
+                        links.append((t, o))
+        return [ flows[x] for x in sorted(flows.keys()) ]
+
+    def rebalance(self, src, dst):
+        now = self.ev.now()
+        flows = self.component(src, dst)
+        for flow in flows:
+            flow.progress(now)
+
+        # progressive filling: saturate the most contended link first
+        capacity = {}
+        users = {}
+        for flow in flows:
+            for link in [ ('out', flow.src), ('in', flow.dst) ]:
+                capacity[link] = 1.0
+                users[link] = users.get(link, 0) + 1
+
+        rates = {}
+        unfrozen = list(flows)
+        while len(unfrozen) > 0:
+            share = min([ capacity[x] / users[x] for x in users
+                          if users[x] > 0 ])
+            bottlenecks = set([ x for x in users if users[x] > 0 and
+                                capacity[x] / users[x] <= share ])
+            rest = []
+            for flow in unfrozen:
+                links = [ ('out', flow.src), ('in', flow.dst) ]
+                if links[0] in bottlenecks or links[1] in bottlenecks:
+                    rates[flow.id] = share
+                    for link in links:
+                        capacity[link] -= share
+                        users[link] -= 1
+                else:
+                    rest.append(flow)
+            unfrozen = rest
+
+        for flow in flows:
+            rate = rates[flow.id]
+            if rate == flow.rate and flow.event.is_pending():
+                continue
+            flow.rate = rate
+            self.ev.reschedule_event(flow.event, flow.remaining / rate)
+
+    def handle_timeout(self, e):
+        if e.kind != event.FLOW:
+            return
+
+        flow = e.get_context()
+        flow.progress(self.ev.now())
+        # a flow ending at the same time may have rescheduled us already
+        self.ev.cancel_event(flow.event)
+        del self.egress[flow.src][flow.id]
+        del self.ingress[flow.dst][flow.id]
+        self.rebalance(flow.src, flow.dst)
+        self.afs.flow_completed(flow)
+
+
+class ChannelNetwork(event.TimeoutEventHandler):
+    """transfer engine with a pool of host-side transfer workers. A transfer
+    needs a free worker, a free read port on its source AFE and a free write
+    port on its destination AFE; it then runs at the full link rate (i.e.
+    takes the cost given by the IO model). Waiting transfers are served
+    according to the queue discipline: 'fifo' (request order) or 'sjf'
+    (shortest transfer first).
+    """
+    def __init__(self, ev, afs, workers=1, ports=1, discipline='fifo'):
+        self.ev = ev
+        self.afs = afs
+        self.workers = workers
+        self.ports = ports
+        self.discipline = discipline
+        self.next_id = 0
+        self.pending = []       # flows waiting for a worker and ports
+        self.active = 0
+        self.reading = {}       # osd -> number of transfers using the port
+        self.writing = {}
+        self.n_flows = 0        # statistics
+        self.max_active = 0
+        self.ev.register_module(self)
+
+    def get_name(self):
+        return 'ChannelNetwork'
+
+    def get_active(self):
+        return self.active
+
+    def start_flow(self, src, dst, cost, context):
+        flow = Flow(self.next_id, src, dst, cost, context)
+        self.next_id += 1
+        self.n_flows += 1
+        flow.started = flow.updated = self.ev.now()
+        self.pending.append(flow)
+        self.dispatch()
+        return flow
+
+    def dispatch(self):
+        if self.active == self.workers or len(self.pending) == 0:
+            return
+        if self.discipline == 'sjf':
+            waiting = sorted(self.pending, key=lambda x: (x.cost, x.id))
+        else:
+            waiting = self.pending
+        started = []
+        for flow in waiting:
+            if self.active == self.workers:
+                break
+            if self.reading.get(flow.src, 0) == self.ports or \
+               self.writing.get(flow.dst, 0) == self.ports:
+                continue
+            self.reading[flow.src] = self.reading.get(flow.src, 0) + 1
+            self.writing[flow.dst] = self.writing.get(flow.dst, 0) + 1
+            self.active += 1
+            flow.rate = 1.0
+            flow.updated = self.ev.now()
+            flow.event = self.ev.alloc_event(event.FLOW, flow.cost, self)
+            flow.event.set_context(flow)
+            self.ev.register_event(flow.event)
+            started.append(flow.id)
+        if len(started) > 0:
+            started = set(started)
+            self.pending = [ x for x in self.pending if x.id not in started ]
+            self.max_active = max(self.max_active, self.active)
+
+    def handle_timeout(self, e):
+        if e.kind != event.FLOW:
+            return
+
+        flow = e.get_context()
+        flow.progress(self.ev.now())
+        self.reading[flow.src] -= 1
+        self.writing[flow.dst] -= 1
+        self.active -= 1
+        self.dispatch()
+        self.afs.flow_completed(flow)
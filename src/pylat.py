@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""In-tree implementation of the entry points of the libanalyzethis scheduling
+library (py_lat_module), used when the C library is not built. The platform
+is read from the same configuration file:
+
+    [AFE]
+    cores_per_afe = 2
+
+    [SERVERS]
+    number_afes = 4
+
+The policies are simple: the files are placed round-robin on the AFEs, a task
+goes to the AFE storing most of its (existing) input data, round-robin if it
+has none, and the device scheduler hands the tasks to the cores round-robin.
+The workflows are not statically placed. The batch variants place a list of
+tasks or files in one call, from numpy arrays instead of strings.
+"""
+
+import re
+import ConfigParser
+import numpy as np
+
+_platform = {
+    'verbose': 0,
+    'afes': 1,
+    'cores': 1,
+}
+
+_next = {
+    'file': 0,      # round-robin cursors
+    'task': 0,
+    'core': 0,
+}
+
+def lat_module_init(*args):
+    """key/value pairs, e.g. ("verbose", "1", "ini_config_file", path)"""
+    if len(args) % 2 != 0:
+        return -1
+    options = dict(zip(args[0::2], args[1::2]))
+    _platform['verbose'] = int(options.get('verbose', 0))
+    if 'ini_config_file' in options:
+        config = ConfigParser.ConfigParser()
+        if len(config.read(options['ini_config_file'])) == 0:
+            return -1
+        try:
+            _platform['cores'] = config.getint('AFE', 'cores_per_afe')
+            _platform['afes'] = config.getint('SERVERS', 'number_afes')
+        except (ConfigParser.Error, ValueError):
+            return -1
+    if _platform['afes'] < 1 or _platform['cores'] < 1:
+        return -1
+    return 0
+
+def lat_device_sched_init():
+    _next['core'] = 0
+    return 0
+
+def lat_host_sched_init():
+    _next['file'] = 0
+    _next['task'] = 0
+    return 0
+
+def lat_meta_sched_init():
+    return 0
+
+def lat_host_sched_file():
+    """AFE where to store a new file"""
+    osd = _next['file']
+    _next['file'] = (osd + 1) % _platform['afes']
+    return osd
+
+def lat_host_sched_file_batch(count):
+    """AFEs of count new files (numpy array)"""
+    osds = (_next['file'] + np.arange(count)) % _platform['afes']
+    _next['file'] = (_next['file'] + count) % _platform['afes']
+    return osds
+
+def parse_inputs(inputs):
+    """'name:size:location:' for every input file of a task (the names may
+    contain colons)
+    """
+    fields = re.findall(r'(.*?):(-?\d+):(-?\d+):', inputs)
+    sizes = [ int(x[1]) for x in fields ]
+    locations = [ int(x[2]) for x in fields ]
+    return (sizes, locations)
+
+def lat_host_sched_task(name, inputs):
+    """AFE where to run a task, given its input files (see parse_inputs)"""
+    (sizes, locations) = parse_inputs(inputs)
+    return int(lat_host_sched_task_batch(np.array(sizes, dtype=np.int64),
+                                         np.array(locations, dtype=int),
+                                         np.array([ len(sizes) ]))[0])
+
+def lat_host_sched_task_batch(sizes, locations, counts):
+    """AFEs of a list of tasks. sizes and locations describe the input files
+    of all the tasks, one after the other, counts[i] being the number of
+    input files of task i. Returns a numpy array.
+    """
+    afes = _platform['afes']
+    task = np.repeat(np.arange(len(counts)), counts)
+    # only the files created and stored on an AFE count
+    valid = (sizes > 0) & (locations >= 0) & (locations < afes)
+    data = np.zeros((len(counts), afes), dtype=np.int64)
+    np.add.at(data, (task[valid], locations[valid]), sizes[valid])
+
+    osds = np.argmax(data, axis=1)
+    nodata = np.flatnonzero(data.max(axis=1) == 0)
+    osds[nodata] = (_next['task'] + np.arange(len(nodata))) % afes
+    _next['task'] = (_next['task'] + len(nodata)) % afes
+    return osds
+
+def lat_device_sched_task():
+    """core of the AFE to run a task on"""
+    core = _next['core']
+    _next['core'] = (core + 1) % _platform['cores']
+    return core
+
+def lat_meta_sched_workflow(workflow):
+    """returns the workflow file to run, with its static placement"""
+    return (0, workflow)
@@ -2,6 +2,8 @@
 
 from itertools import *
 from functools import reduce
+import heapq
+import numpy as np
 import activefs
 import logging
 
@@ -21,26 +23,90 @@ class WorkflowScheduler:
 """ Code for the scheduling at the device level (multi-core devices)
 """
 class DeviceScheduler:
+    """Interface of the device schedulers. The device asks for the next task
+    of its tq (an index) and for the core to run it on, until
+    SCHED_LOOP_DONE; a core tells when it is done with a task, and how
+    long it was busy with it (IO phase included).
+    """
     # A class specific constants
     (SCHED_LOOP_DONE, SCHED_LOOP_CONT) = (-1, -2)
-    def __init__(self):
+    def __init__(self, device):
         self.init = True
 
-class DeviceSchedFirstFreeCore(DeviceScheduler):
+    def next_task(self, device):
+        return 0
+
     def schedule_task(self, device, task):
-        for i in range(device.num_cores):
-            if device.cores[i].running != None:
-                continue
-    
-            # If a core is not running any task, we transfer a task
-            # to the core's tq
-            if (len(device.tq) > 0 and device.cores[i].running == None):
-                return i
-
-        # If we reach this point, it means that we could not assign any
-        # task and the scheduler loop terminated
         return self.SCHED_LOOP_DONE
 
+    def core_released(self, core_id, busy):
+        pass
+
+class DeviceSchedLib(DeviceScheduler):
+    """the scheduling library picks the core (which may be busy, the task
+    then waits in the core queue)
+    """
+    def schedule_task(self, device, task):
+        return device.config.py_lat_module.lat_device_sched_task ()
+
+class DeviceSchedFirstFreeCore(DeviceScheduler):
+    """tasks only go to free cores, the lowest one first. The free cores are
+    kept in a bitmap.
+    """
+    def __init__(self, device):
+        self.free = (1 << device.num_cores) - 1
+
+    def schedule_task(self, device, task):
+        if self.free == 0:
+            # If we reach this point, it means that we could not assign any
+            # task and the scheduler loop terminated
+            return self.SCHED_LOOP_DONE
+        i = (self.free & -self.free).bit_length() - 1
+        self.free &= ~(1 << i)
+        return i
+
+    def core_released(self, core_id, busy):
+        self.free |= 1 << core_id
+
+class DeviceSchedLeastLoaded(DeviceScheduler):
+    """tasks go to the free core which has been busy for the shortest time
+    so far (min-heap of the free cores)
+    """
+    def __init__(self, device):
+        self.busy = [ 0.0 ] * device.num_cores
+        self.free = [ (0.0, i) for i in range(device.num_cores) ]
+
+    def schedule_task(self, device, task):
+        if len(self.free) == 0:
+            return self.SCHED_LOOP_DONE
+        (busy, i) = heapq.heappop(self.free)
+        return i
+
+    def core_released(self, core_id, busy):
+        self.busy[core_id] += busy
+        heapq.heappush(self.free, (self.busy[core_id], core_id))
+
+class DeviceSchedShortestJob(DeviceSchedFirstFreeCore):
+    """the shortest queued task goes first, to the lowest free core"""
+    def next_task(self, device):
+        shortest = 0
+        for i in range(1, len(device.tq)):
+            if device.tq[i].runtime < device.tq[shortest].runtime:
+                shortest = i
+        return shortest
+
+device_schedulers = {
+    'lib': DeviceSchedLib,
+    'firstavailable': DeviceSchedFirstFreeCore,
+    'firstfree': DeviceSchedFirstFreeCore,
+    'leastloaded': DeviceSchedLeastLoaded,
+    'sjf': DeviceSchedShortestJob,
+}
+
+# the scheduling library only knows about the cores of the AFEs
+host_schedulers = dict([ (k, v) for (k, v) in device_schedulers.items()
+                         if k != 'lib' ])
+
 """ Code for the scheduling across multiple devices
 """
 
@@ -50,6 +116,9 @@ class Scheduler:
     def __init__(self, afs):
         self.afs = afs
 
+    """the job is submitted (or the scheduler replaced one in a running
+    simulation), afs.tq holds the tasks which are not prepared yet.
+    """
     def job_submitted(self):
         pass
 
@@ -64,139 +133,108 @@ class Scheduler:
         pass
 
 class SchedWA(Scheduler):
-    """Scheduling policy aiming at decreasing the write amplification ratio
+    """Scheduling policy aiming at decreasing the write amplification ratio,
+    i.e. the fraction of its input data a task needs transferred to the AFE
+    it is placed on.
     """
-    def get_task_total_input_size(self, task):
-        """ Simple function that returns the total size of all the input
-            files for a given task
-        """
-        total_input_size = 0
-        for f in task.input:
-            total_input_size += f.size
-        print 'Total size of the input files: ', total_input_size, ' - task: ', task.name
-        return total_input_size
-
-    def size_required_data_transfer(self, task, afe):
-        """ Function that return the write amplification ratio for a given placement of
-            a task on a target AFE
-        """
-        print 'Calculating the amount of data if assigning task to AFE ', afe.id
-        transfer = 0
-        for f in task.input:
-            print '\tCurrent location of file: ', f.name, ': ', f.location, ' - Potential target: ', afe.id
-            if f.location != afe.id:
-                transfer += f.size
-        print 'Total size of files to transfer: ', transfer, ' - task: ', task.name, '  - AFE ID: ', afe.id
-        return transfer
-
-    def get_task_wa_for_afe(self, task, afe):
-        """ Function that returns the write amplification ratio if the task
-            is assigned to a target AFE
+    def wa_matrix(self, tasks, afes):
+        """tasks x AFEs matrix of the write amplification ratios, built in a
+        single pass over the input files
         """
-        data_moved = self.size_required_data_transfer(task, afe)
-        total_data = self.get_task_total_input_size(task)
-        wa = 1.000 * data_moved / total_data
-        print 'WA ratio for assigning task ', task.name, 'to AFE ', afe.id, ': ', wa, '(', data_moved, '/', total_data, ')'
-        return wa
-
-    def get_task_min_wa(self, task, afes):
-        """ Get the lowest write amplification ratio when concidering allocating a
-            task on a set of AFEs
+        column = dict([ (afe.id, j) for (j, afe) in enumerate(afes) ])
+        local = np.zeros((len(tasks), len(afes)))
+        total = np.zeros(len(tasks))
+        for (i, task) in enumerate(tasks):
+            for f in task.input:
+                total[i] += f.size
+                j = column.get(f.location)
+                if j != None:
+                    local[i, j] += f.size
+        moved = total[:, np.newaxis] - local
+        # tasks without input data cost nothing anywhere
+        total[total == 0] = 1
+        return moved / total[:, np.newaxis]
+
+    def assign(self, wa, capacity):
+        """min-cost assignment of the tasks (rows) to the AFEs (columns),
+        each AFE taking at most capacity tasks. Successive shortest paths:
+        the tasks are added one by one, possibly moving already placed tasks
+        between AFEs (Bellman-Ford on the AFEs only, as they are few).
+        The cheapest move of a placed task from AFE j to AFE k comes from a
+        heap per (j, k), only the heaps of the AFEs whose tasks changed are
+        updated. Returns the AFE index of every task.
         """
-        min_wa = float(-1)
-        select_afe_index = 0
-        for i in range(len(afes)):
-            wa = self.get_task_wa_for_afe(task, afes[i])
-            if (min_wa == -1):
-                min_wa = wa
-                select_afe_index = i
-            elif (wa < min_wa):
-                min_wa = wa
-                select_afe_index = i
-        print '\n\n'
-        return min_wa, select_afe_index
+        (n_tasks, n_afes) = wa.shape
+        osd = np.zeros(n_tasks, dtype=int)
+        load = np.zeros(n_afes, dtype=int)
+        cols = np.arange(n_afes)
+        # (cost of moving task t from j to k, t) for the tasks t placed on j;
+        # the entries of the tasks which left j are dropped when on top
+        heaps = [ [ [] for k in cols ] for j in cols ]
+        move = np.full((n_afes, n_afes), np.inf)
+        mover = np.zeros((n_afes, n_afes), dtype=int)
+
+        def place(t, j):
+            osd[t] = j
+            delta = (wa[t] - wa[t, j]).tolist()
+            for k in range(n_afes):
+                if k != j:
+                    heapq.heappush(heaps[j][k], (delta[k], t))
+
+        def update(j):
+            for k in range(n_afes):
+                h = heaps[j][k]
+                while len(h) > 0 and osd[h[0][1]] != j:
+                    heapq.heappop(h)
+                if len(h) > 0:
+                    (move[j, k], mover[j, k]) = h[0]
+                else:
+                    move[j, k] = np.inf
+
+        for i in range(n_tasks):
+            dist = wa[i].copy()
+            pred = np.full(n_afes, -1, dtype=int)
+            for r in range(n_afes - 1):
+                via = dist[:, np.newaxis] + move
+                j = np.argmin(via, axis=0)
+                # tolerance: rounding must not make zero-cost cycles look
+                # negative (the predecessors would loop)
+                shorter = via[j, cols] < dist - 1e-9
+                if not shorter.any():
+                    break
+                dist[shorter] = via[j, cols][shorter]
+                pred[shorter] = j[shorter]
+
+            dist[load >= capacity] = np.inf
+            k = int(np.argmin(dist))
+            load[k] += 1
+            changed = set([ k ])
+            while pred[k] != -1:
+                j = pred[k]
+                place(mover[j, k], k)
+                changed.add(j)
+                k = j
+            place(i, k)
+            for j in changed:
+                update(j)
+        return osd
 
     def task_prepared(self, ready_list):
+        """All tasks are placed at once and the same number of tasks (rounded
+        up) goes to each AFE. This may not be the most efficient placement
+        since we do not take into account the execution time of a task, but
+        we focus on decreasing the write amplification while keeping a
+        parallel execution of tasks.
+        """
         afes = list(self.afs.osds)
         tasks = list(ready_list)
+        if len(tasks) == 0:
+            return
 
-        """ All tasks must be placed in the context of the execution of this function
-            because of a current implementation limitation. Because of that, we calculate
-            how many tasks must be assigned to the different AFEs so that the same number
-            of tasks is assigned to each AFE. This may not be the most efficient placement
-            since we do not take into account to execution time of a task but we currently
-            focus only decreasing the Write Amplification and still have a parallel
-            execution of tasks
-        """
-        tasks_per_afe = len(tasks) / len(afes)
-        print tasks_per_afe, " tasks must be assigned to each AFE"
-        j = 0
-        while len(afes) > 0 and len(tasks) > 0:
-            print len(tasks), " tasks candidate for placement on ", len(afes), " AFEs"
-
-            i = 0
-            min_wa = -1
-            select_task_index = 0
-            select_afe_index = 0
-            select_task_name = ''
-            select_afe_id = -1
-            afes_assigned_tasks = [0]*len(afes)
-
-            while (i < len(tasks)):
-                task_wa, afe_index = self.get_task_min_wa(tasks[i], afes)
-                if min_wa == -1:
-                    min_wa = task_wa
-                    select_task_index = i
-                    select_afe_index = afe_index
-                    select_task_name = tasks[i].name
-                    if (select_afe_index < len(afes)):
-                        select_afe_id = afes[select_afe_index].id
-                    else:
-                        print 'Error: index ', select_afe_index, 'is outside of array (size: ', len(afes), ')'
-                        return
-                elif (task_wa < min_wa):
-                    min_wa = task_wa
-                    select_task_index = i
-                    select_afe_index = afe_index
-                    select_afe_id = afes[select_afe_index].id
-                    select_task_name = tasks[i].name
-                i = i + 1
-
-            print '\n\nLoop ', j, 'task ', select_task_name, '(index: ', select_task_index, ') is selected to be executed on AFE ', select_afe_id
-            print '\n\n'
-
-            """ We update the placement of the select task
-            """
-            print 'Select AFE ID: ', select_afe_id, ' - task index: ', select_task_index
-            index_target_osd = 0
-            while (self.afs.osds[index_target_osd].id != select_afe_id):
-                index_target_osd = index_target_osd + 1
-
-            i = 0
-            while (ready_list[i].name != select_task_name):
-                i = i + 1
-            ready_list[i].osd = index_target_osd
-            
-            """ We remove the task from the local list of tasks that
-                need to be scheduled
-            """
-            if (select_task_index < len(tasks)):
-                tasks.pop(select_task_index)
-            else:
-                print 'Error: index ', select_task_index, ' is outside of array (size: ', len(tasks), ')'
-
-            """ We save the fact that the AFE has one more task assigned
-            """
-            afes_assigned_tasks[select_afe_index] = afes_assigned_tasks[select_afe_index] + 1
-            """ If the max of tasks has been assigned to the AFE, we remove it
-                from the local list of available AFEs
-            """
-            if (len(afes_assigned_tasks) > 1 and afes_assigned_tasks[select_afe_index] == tasks_per_afe):
-                print "Marking AFE ", select_afe_index, "as busy"
-                afes.pop(select_afe_index)
-
-            j = j + 1
-        print "\n\n\n*********************************\n\n\n"
+        tasks_per_afe = (len(tasks) + len(afes) - 1) / len(afes)
+        osd = self.assign(self.wa_matrix(tasks, afes), tasks_per_afe)
+        for (task, j) in zip(tasks, osd):
+            task.osd = int(j)
 
 class SchedLib(Scheduler):
     """This implementation uses the libanalysethis scheduler
@@ -216,10 +254,11 @@ class SchedLib(Scheduler):
             self.logger.propagate = False
 
     def job_submitted(self):
-        sorted_tasks = list(map(lambda x: x[1],
-                            sorted(self.afs.job.tasks.items())))
+        sorted_tasks = sorted(self.afs.tq, key=lambda x: x.name)
+        if hasattr(self.config.py_lat_module, 'lat_host_sched_task_batch'):
+            self.place_tasks(sorted_tasks)
+            return
         for task in sorted_tasks:
-            n_input = reduce(lambda x, y: x+y, [ f.size for f in task.input ])
             _str = ""
             for f in task.input:
                 _str = _str + f.name + ':' + str(f.size) + ':' + str(f.location) + ':'
@@ -228,12 +267,25 @@ class SchedLib(Scheduler):
                                (osd, task.name))
             task.osd = osd
 
+    def place_tasks(self, tasks):
+        """all the tasks in one call, the input files of the tasks being
+        described by arrays
+        """
+        files = [ f for task in tasks for f in task.input ]
+        osds = self.config.py_lat_module.lat_host_sched_task_batch(
+                np.array([ f.size for f in files ], dtype=np.int64),
+                np.array([ f.location for f in files ], dtype=int),
+                np.array([ len(task.input) for task in tasks ], dtype=int))
+        for (task, osd) in zip(tasks, osds):
+            self.logger.debug ("Assigning AFE %d to task: %s" % \
+                               (osd, task.name))
+            task.osd = int(osd)
+
 class SchedRR(Scheduler):
     """Basic round-robin scheduler
     """
     def job_submitted(self):
-        sorted_tasks = list(map(lambda x: x[1],
-                            sorted(self.afs.job.tasks.items())))
+        sorted_tasks = sorted(self.afs.tq, key=lambda x: x.name)
         for (task, osd) in zip(sorted_tasks,
                                cycle(range(self.afs.config.osds))):
             print "Assigning OSD %d to task\n" % osd
@@ -307,56 +359,103 @@ class SchedInputEnhanced(Scheduler):
 
 class SchedMinWait(Scheduler):
     def task_prepared(self, ready_list):
-        """ calculate expected wait time for all osds
+        """ expected wait time for all osds (see ActiveFlash.get_qtime)
         """
-        wait = [ 0.0 ] * self.afs.config.osds
-
-        """get the queue population
-        """
-        for i in range(self.afs.config.osds):
-            if len(self.afs.osds[i].tq) > 0:
-                wait[i] = self.afs.osds[i].get_qtime()
+        wait = [ osd.get_qtime() for osd in self.afs.osds ]
 
         """ assign osds for tasks
         """
         for task in ready_list:
-            """get the file distribution
-            """
-            fsize = [0] * self.afs.config.osds
-            for f in task.input:
-                fsize[f.location] += f.size
-            fsize_total = reduce(lambda x,y: x+y, fsize)
-            for i in range(self.afs.config.osds):
-                wait[i] = wait[i] + \
-                    (float(fsize_total - fsize[i]) / self.afs.config.netbw)
-
-            """select the minimum wait time one
-            """
-            osd = wait.index(min(wait))
+            osd = self.min_wait(task, wait)
             task.osd = osd
 
-            """need to update the wait time
+            """need to update the wait time, the task is not submitted
+            before its input files are transferred
             """
-            wait = [ 0.0 ] * self.afs.config.osds
-            wait[osd] += task.runtime   # consider the current task
-            for i in range(self.afs.config.osds):
-                if len(self.afs.osds[i].tq) > 0:
-                    wait[i] = self.afs.osds[i].get_qtime()
+            afe = self.afs.osds[osd]
+            wait[osd] += afe.get_runtime(task) / afe.num_cores
+
+    def min_wait(self, task, wait):
+        """the osd where the task would start the earliest, counting the
+        transfer of its input files
+        """
+        fsize = [0] * self.afs.config.osds
+        for f in task.input:
+            fsize[f.location] += f.size
+        fsize_total = sum(fsize)
+        start = [ wait[i] + float(fsize_total - fsize[i]) / self.afs.config.netbw
+                  for i in range(self.afs.config.osds) ]
+        return start.index(min(start))
+
+class SchedHEFT(Scheduler):
+    """Critical-path list scheduler (HEFT). The upward rank of a task is the
+    length of the longest path from the task to the end of the workflow,
+    counting the runtimes and the transfers of the files between the tasks.
+    The ranks are computed once at submission, in reverse topological order.
+    The prepared tasks are placed, highest rank first, on the AFE where they
+    would finish the earliest, given the estimated time each core of each
+    AFE becomes available.
+    """
+    def job_submitted(self):
+        tasks = self.afs.job.tasks.values()
+        iomod = self.afs.iomod
+        # keyed by id(task), hashing old-style instances is slow
+        self.rank = {}
+        # Kahn's algorithm from the exit tasks, over the file dependencies
+        # (a file written by several tasks depends on its last producer)
+        children = dict([ (id(t), 0) for t in tasks ])
+        for t in tasks:
+            for f in t.input:
+                if f.producer is not None:
+                    children[id(f.producer)] += 1
+        ranked = [ t for t in tasks if children[id(t)] == 0 ]
+        while len(ranked) > 0:
+            t = ranked.pop()
+            longest = 0.0
+            for f in t.output:
+                if f.producer is t and len(f.consumers) > 0:
+                    cost = iomod.get_size_cost(abs(f.size))
+                    longest = max(longest, cost +
+                                  max([ self.rank[id(c)] for c in f.consumers ]))
+            self.rank[id(t)] = t.runtime + longest
+            for f in t.input:
+                p = f.producer
+                if p is not None:
+                    children[id(p)] -= 1
+                    if children[id(p)] == 0:
+                        ranked.append(p)
+
+        # per AFE, min-heap of the times its cores become available
+        self.avail = [ [ 0.0 ] * afe.num_cores for afe in self.afs.osds ]
+
+    def finish_time(self, task, osd, now):
+        afe = self.afs.osds[osd]
+        ready = now
+        for f in task.input:
+            if not f.is_replicated(osd):
+                ready += self.afs.iomod.get_transfer_cost(f)
+        start = max(ready, self.avail[osd][0])
+        return start + afe.get_runtime(task)
 
+    def task_prepared(self, ready_list):
+        now = self.afs.ev.now()
+        for task in sorted(ready_list, key=lambda x: (-self.rank[id(x)], x.name)):
+            finish = [ self.finish_time(task, i, now)
+                       for i in range(len(self.afs.osds)) ]
+            osd = finish.index(min(finish))
+            task.osd = osd
+            heapq.heapreplace(self.avail[osd], finish[osd])
 
 class SchedHostOnly(Scheduler):
     def task_prepared(self, ready_list):
         for task in ready_list:
             task.host = True
 
-class SchedHostReduce(Scheduler):
+class SchedHostReduce(SchedMinWait):
     def task_prepared(self, ready_list):
         """The scheduling is based on the minwait
         """
-        wait = [ 0.0 ] * self.afs.config.osds
-        for i in range(self.afs.config.osds):
-            if len(self.afs.osds[i].tq) > 0:
-                wait[i] = self.afs.osds[i].get_qtime()
+        wait = [ osd.get_qtime() for osd in self.afs.osds ]
 
         for task in ready_list:
             osd_list = []
@@ -370,28 +469,12 @@ class SchedHostReduce(Scheduler):
             """
             if len(osd_list) > self.afs.config.osds * 0.5:
                 task.host = True
-                return
+                continue
 
             """fall back to minwait
             """
-            fsize = [0] * self.afs.config.osds
-            for f in task.input:
-                fsize[f.location] += f.size
-            fsize_total = reduce(lambda x,y: x+y, fsize)
-            for i in range(self.afs.config.osds):
-                wait[i] = wait[i] + \
-                    (float(fsize_total - fsize[i]) / self.afs.config.netbw)
-
-            """select the minimum wait time one
-            """
-            osd = wait.index(min(wait))
+            osd = self.min_wait(task, wait)
             task.osd = osd
-
-            """need to update the wait time
-            """
-            wait = [ 0.0 ] * self.afs.config.osds
-            wait[osd] += task.runtime   # consider the current task
-            for i in range(self.afs.config.osds):
-                if len(self.afs.osds[i].tq) > 0:
-                    wait[i] = self.afs.osds[i].get_qtime()
+            afe = self.afs.osds[osd]
+            wait[osd] += afe.get_runtime(task) / afe.num_cores
 
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import os
 import sys
 import argparse
 import textwrap
@@ -14,11 +15,19 @@ import event
 import activefs
 import cluster
 import job
+import cache
+import iomodel
+import sched
 
 # The scheduling library is always required since it is for instance used
 # to determine file placement. See the README file for details about how
-# to setup and use that library.
-import py_lat_module
+# to setup and use that library. When it is not built, the in-tree pylat
+# module implements the same entry points.
+try:
+    import py_lat_module
+except ImportError:
+    py_lat_module = None
+import pylat
 
 class PassiveSimulator(event.EventSimulator):
     """This class has been added to simulate the situations when the jobs are
@@ -59,6 +68,8 @@ class DistributedPlatformSimulator():
         print "Success.\n"
 
         self.py_lat_module = py_lat_module
+        options.py_lat_module = py_lat_module
+        options.host_type = 'server'
 
         # Setup the virtual platform
         self.cluster = cluster.Cluster(options)
@@ -66,6 +77,16 @@ class DistributedPlatformSimulator():
     def check_termination(self):
         return self.afs.check_termination()
 
+    def enable_profiling(self, interval):
+        profile = self.cluster.enable_profiling(interval)
+        # the first server runs the workflow
+        profile.add_gauge('task_queues',
+                          self.cluster.servers[0].afs.get_queue_depths)
+        return profile
+
+    def get_profile(self):
+        return self.cluster.profile
+
     def report(self):
         self.cluster.report()
 
@@ -96,7 +117,9 @@ class ActiveSimulator(event.EventSimulator):
     """Active Flash simulator
     """
     def __init__(self, options):
-        event.EventSimulator.__init__(self)
+        event.EventSimulator.__init__(self, options.eventqueue,
+                                     options.eventlog != '',
+                                     options.delta)
         self.options = options
         options.host_type = 'server'
 
@@ -148,6 +171,39 @@ class ActiveSimulator(event.EventSimulator):
     def check_termination(self):
         return self.afs.check_termination()
 
+    def get_profile(self):
+        return self.profile
+
+    def enable_profiling(self, interval):
+        profile = event.EventSimulator.enable_profiling(self, interval)
+        # time the scheduling decisions as well
+        self.afs.scheduler = profile.wrap(self.afs.scheduler, 'scheduler')
+        self.options.py_lat_module = profile.wrap(py_lat_module,
+                                                  'py_lat_module')
+        profile.add_gauge('task_queues', self.afs.get_queue_depths)
+        return profile
+
+    def run_branches(self, until, schedulers):
+        """Simulate the shared prefix of the workflow up to the time 'until',
+        then fork one child per scheduler to simulate the rest (what-if
+        branches). The branches run one after the other so that their
+        reports do not interleave.
+        """
+        self.run(until)
+        print '\nsimulation forked at %.3f' % self.now()
+        for name in schedulers:
+            pid = self.fork()
+            if pid == 0:
+                if name != self.afs.config.scheduler:
+                    self.afs.switch_scheduler(name)
+                finish = self.run()
+                self.report()
+                print('\nsimulation finished at %.3f' % finish)
+                sys.stdout.flush()
+                os._exit(0)
+            os.waitpid(pid, 0)
+        return self.now()
+
     def report(self):
         print '\n-----------------------------------------'
         print '\n Simulation report'
@@ -165,17 +221,12 @@ class ActiveSimulator(event.EventSimulator):
         print '\nOSD busy intervals'
         busy = []
         for i in range(len(self.afs.osds)):
-            intervals = [ (t.stat.t_start, t.stat.t_complete)
-                          for t in self.afs.job.tasks.values() if t.osd == i]
-            if len(intervals) > 0:
-                busy += [ reduce(lambda x, y: x+y,
-                                 map(lambda (x, y): y-x, intervals)) ]
-            else:
-                busy += [ 0.0 ]
+            m = self.afs.osds[i].metrics
+            busy += [ m.busy ]
             print 'OSD %d: %.3f sec\n\t[%s]' % \
                     (i, busy[-1],
                      ', '.join('(%.2f, %.2f)' % (x,y) for x,y in
-                             sorted(intervals, key=lambda x: x[0])))
+                             sorted(m.intervals, key=lambda x: x[0])))
 
         util_mean = scipy.mean(busy) / self.afs.ev.current * 100
         util_std = scipy.std(busy) / self.afs.ev.current * 100
@@ -183,11 +234,36 @@ class ActiveSimulator(event.EventSimulator):
         print '\nOSD mean utilization = %.3f' % util_mean
         print 'OSD std utilization = %.3f' % util_std
 
+        print '\nAFE queue statistics'
+        print '%-3s%8s%12s%10s%10s' % \
+                ('OSD', 'Tasks', 'Mean queue', 'Xfer in', 'Xfer out')
+        for osd in self.afs.osds:
+            m = osd.metrics
+            print '%3d%8d%12.3f%10d%10d' % \
+                    (osd.id, m.get_tasks(), m.queue.mean(self.afs.ev.current),
+                     m.transfers_in, m.transfers_out)
+            if osd.num_cores > 1:
+                print '\tcore busy: [%s]' % \
+                        ', '.join('%.2f' % c.metrics.busy for c in osd.cores)
+        if self.afs.host != None:
+            m = self.afs.host.metrics
+            print 'Host: %d tasks, %.3f sec busy, mean queue %.3f, ' \
+                  '%d transfers in' % \
+                    (m.get_tasks(), m.busy, m.queue.mean(self.afs.ev.current),
+                     m.transfers_in)
+            print '\tcore busy: [%s]' % \
+                    ', '.join('%.2f' % c.metrics.busy
+                              for c in self.afs.host.cores)
+
         """SSD statistics
         """
         print '\nSSD RW statistics'
+        evictions = self.afs.config.cache_size > 0
         print '%-3s%11s%11s%11s%11s' % \
-                ('OSD', 'Total R', 'Total W', 'Extra R', 'Extra W')
+                ('OSD', 'Total R', 'Total W', 'Extra R', 'Extra W'),
+        if evictions:
+            print '%11s%10s' % ('Evicted', 'Replicas'),
+        print
         total_read = 0
         total_write = 0
         for i in range(len(self.afs.osds)):
@@ -197,10 +273,13 @@ class ActiveSimulator(event.EventSimulator):
             extra_write = self.afs.osds[i].get_extra_write()
             print repr(i).rjust(3),
             print repr(total_read).rjust(10), repr(total_write).rjust(10),
-            print repr(extra_read).rjust(10), repr(extra_write).rjust(10)
+            print repr(extra_read).rjust(10), repr(extra_write).rjust(10),
+            if evictions:
+                print repr(self.afs.osds[i].get_evicted()).rjust(10),
+                print repr(self.afs.osds[i].get_evictions()).rjust(9),
+            print
 
-        total_transfer = reduce(lambda x, y: x+y,
-                           [ osd.get_extra_read() for osd in self.afs.osds ])
+        total_transfer = sum([ osd.get_extra_read() for osd in self.afs.osds ])
         reads = map(lambda x: x.get_total_read(), self.afs.osds)
         writes = map(lambda x: x.get_total_write(), self.afs.osds)
 
@@ -214,6 +293,15 @@ class ActiveSimulator(event.EventSimulator):
         print '\nTotal data transfer = %d bytes (%.3f MB)' % \
                     (total_transfer, float(total_transfer) / (2**20))
         print 'Number of transfers: %d' % self.afs.num_transfers
+        if self.afs.network != None:
+            print 'Network flows: %d (at most %d at once)' % \
+                    (self.afs.network.n_flows, self.afs.network.max_active)
+        if self.afs.config.steal != 'none':
+            print 'Work steals: %d between cores, %d between AFEs' % \
+                    tuple(self.afs.num_steals)
+        if self.afs.config.prefetch > 0:
+            print 'Number of prefetches: %d (input stall saved: %.3f sec)' % \
+                    (self.afs.num_prefetches, self.afs.prefetch_saved)
         print 'SSD mean read = %d bytes (%.3f MB)' % \
                     (rmean, float(rmean) / (2**20))
         print 'SSD mean write = %d bytes (%.3f MB)' % \
@@ -236,14 +324,14 @@ def parse_config_file(conffile):
     
 
 
-"""main program
+"""command line (sys.argv by default), checked
 """
-def main():
+def parse_args(argv=None):
     args_description = textwrap.dedent("""\
             ActiveFS scheduling simulator. Currently only simulates a single
             job execution. The default options are identical to:
 
-                --netbw 262144000 --osds 4 --scheduler rr --placement rr --core 2 --deviceScheduler firstAvailable --file my_file.conf
+                --netbw 262144000 --osds 4 --scheduler rr --placement rr --core 2 --deviceScheduler lib --file my_file.conf
 
             netbw is 250 MB/s by default.
 
@@ -254,13 +342,28 @@ def main():
               minwait: task is placed where waiting time is minimal
               hostonly: only host is used
               hostreduce: reduce tasks are scheduled to hybrid
+              heft: critical-path list scheduling (earliest finish time)
               core: number of cores per AFE (supposed to be homogeneous across
                     the platform at the moment)
 	      file: configuration file describing the experiment
 
+            The following file transfer models are available:
+              serial: one transfer at a time, as the emulator (default)
+              flow: concurrent flows sharing the AFE links fairly
+              channel: a pool of transfer workers, with a per-AFE port limit
+
+            The following event queue backends are available:
+              heap: binary heap (default)
+              calendar: calendar queue, simultaneous events in O(1)
+
             The following device schedulers are available:
-                firstAvailable: the first available device's core (i.e., core
-                                that does not execute any task) is used
+                lib: rely on the scheduling library (default)
+                firstAvailable (or firstfree): the first available device's
+                                core (i.e., core that does not execute any
+                                task) is used
+                leastloaded: the available core which has been busy for the
+                             shortest time is used
+                sjf: the shortest queued task goes to the first available core
 
             The following data placement policies are available:
               rr: round-robin (default)
@@ -285,8 +388,11 @@ def main():
     parser.add_argument('-s', '--scheduler', type=str, default='schedlib',
                         help='job scheduler')
     parser.add_argument('-S', '--deviceScheduler', type=str,
-                        default='firstAvailable',
-                        help='device scheduler')
+                        default='lib',
+                        choices=sorted(sched.device_schedulers.keys()) +
+                                [ 'firstAvailable' ],
+                        help='device scheduler (default lib, i.e. the '
+                             'scheduling library)')
     parser.add_argument('-p', '--placement', type=str, default='rr',
                         help='dataplacement policy')
     parser.add_argument('-d', '--debug', default=False,
@@ -296,11 +402,102 @@ def main():
                         help='prints eventlogs') #, action='store_true')
     parser.add_argument('-c', '--cores', type=int, default=1,
                         help='number of cores per AFE')
+    parser.add_argument('--flash-channels', type=int,
+                        default=iomodel.SSD_CHANNELS,
+                        help='internal flash channels of an AFE (default %d)'
+                             % iomodel.SSD_CHANNELS)
+    parser.add_argument('--channel-bw', type=int,
+                        default=iomodel.SSD_CHANNEL_BW,
+                        help='bandwidth of a flash channel (bytes/sec)')
+    parser.add_argument('--flash-contention', default=False,
+                        action='store_true',
+                        help='the cores of an AFE share its flash channels '
+                             'for the IO part of their tasks')
+    parser.add_argument('--host-cores', type=int, default=1,
+                        help='number of host cores (hybrid schedulers)')
+    parser.add_argument('--host-scheduler', type=str, default='firstfree',
+                        choices=sorted(sched.host_schedulers.keys()),
+                        help='host core scheduler (default firstfree)')
+    parser.add_argument('--host-placement', type=str, default='rr',
+                        choices=['rr', 'input', 'least'],
+                        help='AFE the host writes the output files to: '
+                             'round-robin (default), the one holding most '
+                             'of the input, or the least written one')
     parser.add_argument('-f', '--file', type=str, default='',
                         help='configuration file')
+    parser.add_argument('--lat-backend', type=str, default='auto',
+                        choices=['auto', 'native', 'python'],
+                        help='scheduling library: the py_lat_module C '
+                             'library (native), the in-tree pylat module '
+                             '(python) or the library if available (auto)')
+    parser.add_argument('--network', type=str, default='serial',
+                        choices=['serial', 'flow', 'channel'],
+                        help='file transfer model (default serial)')
+    parser.add_argument('--transfer-workers', type=int, default=4,
+                        help='number of transfer workers (channel model)')
+    parser.add_argument('--port-limit', type=int, default=1,
+                        help='concurrent reads and writes per AFE '
+                             '(channel model)')
+    parser.add_argument('--dedup', default=False, action='store_true',
+                        help='attach a task to the transfer of a file '
+                             'already requested for the same AFE')
+    parser.add_argument('--multicast', default=False, action='store_true',
+                        help='send a queued file to all the AFEs requesting '
+                             'it at once (implies --dedup)')
+    parser.add_argument('--cache-size', type=int, default=0,
+                        help='replica capacity of an AFE in bytes '
+                             '(default 0, unbounded)')
+    parser.add_argument('--cache-policy', type=str, default='lru',
+                        choices=sorted(cache.eviction_policies.keys()),
+                        help='replica eviction policy (default lru)')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='prefetch the inputs of placed tasks as soon as '
+                             'they are produced, at most n at once '
+                             '(default 0, disabled)')
+    parser.add_argument('--prefetch-budget', type=int, default=0,
+                        help='bytes being prefetched at most '
+                             '(default 0, unlimited)')
+    parser.add_argument('--prepare-window', type=float, default=0.0,
+                        help='the tasks prepared within that time (sec) are '
+                             'handed to the scheduler together (default: '
+                             'the simultaneous ones)')
+    parser.add_argument('--serial-prepare', default=False,
+                        action='store_true',
+                        help='hand the prepared tasks to the scheduler one '
+                             'at a time, as the emulator')
+    parser.add_argument('--steal', type=str, default='none',
+                        choices=['none', 'core', 'all'],
+                        help='work stealing: idle cores steal from their '
+                             'siblings (core), idle AFEs also steal from '
+                             'the other AFEs (all)')
+    parser.add_argument('--steal-margin', type=float, default=0.0,
+                        help='an AFE steals a task only if its input '
+                             'transfers take that much (sec) less than '
+                             'its wait')
+    parser.add_argument('--transfer-queue', type=str, default='fifo',
+                        choices=['fifo', 'sjf'],
+                        help='transfer queue discipline (channel model)')
+    parser.add_argument('--fork-at', type=float, default=None,
+                        help='fork the simulation at the given time')
+    parser.add_argument('--branch', type=str, action='append', default=[],
+                        help='scheduler to continue a forked simulation '
+                             'with (can be repeated)')
+    parser.add_argument('--profile', default=False, action='store_true',
+                        help='print an event loop profile (json) at the end')
+    parser.add_argument('--profile-interval', type=int, default=100,
+                        help='sample the event queue depth and the task '
+                             'queue depths (submitted, prepared, dispatched) '
+                             'every n event batches')
+    parser.add_argument('--delta', default=False, action='store_true',
+                        help='run zero-delay events as delta cycles instead '
+                             'of queueing them like the others (simultaneous '
+                             'events then run in registration order)')
+    parser.add_argument('-q', '--eventqueue', type=str, default='heap',
+                        choices=sorted(event.event_queues.keys()),
+                        help='event queue backend (default heap)')
 
     parser.add_argument('script', type=str, help='job script in XML')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if args.debug:
         print("debug is enabled, launch pdb...")
@@ -324,16 +521,58 @@ def main():
         args.file = tmp_file
     parse_config_file (args.file)
 
+    global py_lat_module
+    if args.lat_backend == 'native' and py_lat_module == None:
+        parser.error('the py_lat_module library is not available')
+    if args.lat_backend == 'python' or py_lat_module == None:
+        py_lat_module = pylat
+
+    if args.fork_at != None and args.nodes != 0:
+        parser.error('--fork-at is only supported for a single host')
+    if args.multicast:
+        args.dedup = True
+    if args.flash_channels < 1 or args.channel_bw < 1:
+        parser.error('--flash-channels and --channel-bw must be positive')
+    if args.prepare_window < 0.0:
+        parser.error('--prepare-window must not be negative')
+    if args.serial_prepare and args.prepare_window > 0.0:
+        parser.error('--serial-prepare excludes --prepare-window')
+    if args.host_cores < 1:
+        parser.error('--host-cores must be positive')
+    if args.transfer_workers < 1 or args.port_limit < 1:
+        parser.error('--transfer-workers and --port-limit must be positive')
+    return args
+
+
+"""main program
+"""
+def main():
+    args = parse_args()
+
     if (args.nodes == 0):
         sim = ActiveSimulator(args)
     else:
         sim = DistributedPlatformSimulator(args)
 
+    if args.profile:
+        sim.enable_profiling(args.profile_interval)
+
     sim.prepare()
+    if args.fork_at != None:
+        if len(args.branch) == 0:
+            args.branch = [ args.scheduler ]
+        sim.run_branches(args.fork_at, args.branch)
+        return 0
+
     finish = sim.run()
     sim.report()
 
     print('\nsimulation finished at %.3f' % finish)
+
+    if args.profile:
+        print('\nEvent loop profile')
+        print(json.dumps(sim.get_profile().summary(), sort_keys=True,
+                         indent=1))
     return 0
 
 
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import StringIO
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SRC)
+
+import sim
+
+def workflow(name):
+    return os.path.join(SRC, 'workflows', name)
+
+def simulate(argv, script='montage_60.xml', profile=None):
+    """runs a single host simulation (in-tree scheduling library), returns
+    the simulator once done, the output of the simulator is discarded.
+    profile is the sampling interval of the event loop profile, if any.
+    """
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        args = sim.parse_args([ '--lat-backend', 'python' ] + argv +
+                              [ workflow(script) ])
+        s = sim.ActiveSimulator(args)
+        if profile != None:
+            s.enable_profiling(profile)
+        s.prepare()
+        s.finish = s.run()
+        s.report()
+    finally:
+        sys.stdout = stdout
+    return s
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import unittest
+
+from simtest import simulate
+import event
+
+def new_event(ts, i):
+    e = event.TimeoutEvent(event.TASK, ts, None)
+    e.set_context(i)
+    return e
+
+def ids(events):
+    return [ e.get_context() for e in events ]
+
+class Chain(event.TimeoutEventHandler):
+    """every event handled registers the next ones with a zero delay"""
+    def __init__(self, ev, fanout, depth):
+        self.ev = ev
+        self.fanout = fanout
+        self.depth = depth
+        self.handled = []
+
+    def handle_timeout(self, e):
+        (level, i) = e.get_context()
+        self.handled.append((self.ev.now(), level, i))
+        if level < self.depth:
+            for j in range(self.fanout):
+                n = self.ev.alloc_event(event.TASK, 0, self)
+                n.set_context((level + 1, i * self.fanout + j))
+                self.ev.register_event(n)
+
+class DeltaTest(unittest.TestCase):
+    def test_default(self):
+        # delta cycles change the order of simultaneous events
+        self.assertEqual(event.EventSimulator().eq.delta, None)
+        self.assertEqual(simulate([]).eq.delta, None)
+
+    def test_batch(self):
+        for queue in event.event_queues.values():
+            q = queue(True)
+            q.push(new_event(1.0, -1))
+            q.pop_batch()
+            q.push(new_event(2.0, 100))
+            handles = [ q.push(new_event(1.0, i)) for i in range(10) ]
+            self.assertEqual(len(q.delta), 10)
+            # cancelled entries are skipped
+            for i in (0, 3, 9):
+                q.cancel(handles[i])
+            self.assertEqual(q.peek(), 1.0)
+            self.assertEqual(ids(q.pop_batch()), [ 1, 2, 4, 5, 6, 7, 8 ])
+            self.assertEqual(ids(q.pop_batch()), [ 100 ])
+            self.assertEqual(len(q), 0)
+
+    def test_cancelled(self):
+        # a delta cycle holding only tombstones
+        for queue in event.event_queues.values():
+            q = queue(True)
+            q.push(new_event(1.0, -1))
+            q.pop_batch()
+            q.push(new_event(3.0, 100))
+            for h in [ q.push(new_event(1.0, i)) for i in range(3) ]:
+                q.cancel(h)
+            self.assertEqual(q.peek(), 3.0)
+            self.assertEqual(ids(q.pop_batch()), [ 100 ])
+
+    def test_order(self):
+        # zero-delay events run level by level, in registration order
+        for queue in event.event_queues:
+            ev = event.EventSimulator(queue, delta=True)
+            chain = Chain(ev, 3, 3)
+            e = event.TimeoutEvent(event.TASK, 1.0, chain)
+            e.set_context((0, 0))
+            ev.register_event(e)
+            ev.run()
+            expected = [ (1.0, level, i) for level in range(4)
+                                         for i in range(3 ** level) ]
+            self.assertEqual(chain.handled, expected)
+
+    def test_simulation(self):
+        s = simulate([ '-n', '4', '-c', '2', '-s', 'locality', '-S',
+                       'firstfree', '--serial-prepare', '--delta' ])
+        self.assertEqual(s.eq.delta, [])
+        self.assertEqual(len(s.eq), 0)
+        for task in s.afs.job.tasks.values():
+            self.assertTrue(0 < task.stat.t_complete <= s.finish)
+
+if __name__ == '__main__':
+    unittest.main()
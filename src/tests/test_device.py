@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+
+import unittest
+
+from simtest import simulate
+
+class LeastLoadedTest(unittest.TestCase):
+    def test_busy(self):
+        # the IO phase counts in the busy time of the cores
+        s = simulate([ '-n', '4', '-c', '4', '-S', 'leastloaded',
+                       '--flash-contention', '--channel-bw', '10000000' ])
+        for osd in s.afs.osds:
+            tasks = [ t for t in s.afs.job.tasks.values()
+                      if t.osd == osd.id and not t.host ]
+            busy = sum([ t.stat.t_complete - t.stat.t_start for t in tasks ])
+            runtime = sum([ t.runtime for t in tasks ])
+            self.assertAlmostEqual(sum(osd.device_scheduler.busy), busy)
+            self.assertTrue(busy > runtime)
+
+
+if __name__ == '__main__':
+    unittest.main()
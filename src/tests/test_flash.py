@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+import unittest
+
+import simtest
+import event
+import iomodel
+
+class Task:
+    def __init__(self, nbytes):
+        self.input_bytes = nbytes
+        self.output_bytes = 0
+
+class Core:
+    def __init__(self, ev, task):
+        self.ev = ev
+        self.running = task
+        self.done = []
+
+    def io_done(self, task, compute):
+        self.done.append((self.ev.now(), compute))
+
+class FlashTest(unittest.TestCase):
+    def run_cores(self, queue, n_cores):
+        ev = event.EventSimulator(queue)
+        flash = iomodel.FlashChannels(ev, 1, 100)
+        cores = [ Core(ev, Task(1000)) for i in range(n_cores) ]
+        for core in cores:
+            flash.start_io(core, core.running, 30.0)
+        ev.run()
+        # the channels are shared: all the IO phases end together
+        for core in cores:
+            self.assertEqual(len(core.done), 1)
+            self.assertAlmostEqual(core.done[0][0], 10.0 * n_cores)
+            self.assertEqual(core.done[0][1], 20.0)
+        self.assertEqual(len(flash.active), 0)
+
+    def test_simultaneous(self):
+        for queue in event.event_queues:
+            for n_cores in (2, 3, 8):
+                self.run_cores(queue, n_cores)
+
+    def test_sipht(self):
+        # used to fire a rescheduled IO phase twice
+        s = simtest.simulate([ '-n', '8', '-c', '8', '--flash-contention',
+                               '-S', 'sjf' ], 'sipht_60.xml')
+        self.assertEqual(sum([ len(osd.flash.active)
+                               for osd in s.afs.osds ]), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+
+import unittest
+
+import sched
+from simtest import simulate
+
+class HostSchedulerTest(unittest.TestCase):
+    def test_host_schedulers(self):
+        for name in sorted(sched.host_schedulers.keys()):
+            for scheduler in [ 'hostonly', 'hostreduce' ]:
+                s = simulate([ '-n', '4', '-c', '4', '-s', scheduler,
+                               '--host-cores', '2',
+                               '--host-scheduler', name ])
+                host = s.afs.host
+                self.assertTrue(host.metrics.get_tasks() > 0)
+                self.assertTrue(s.afs.check_termination())
+
+    def test_lib_rejected(self):
+        self.assertRaises(SystemExit, simulate,
+                          [ '-s', 'hostonly', '--host-scheduler', 'lib' ])
+
+
+if __name__ == '__main__':
+    unittest.main()
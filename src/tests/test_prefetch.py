@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+
+import unittest
+
+from simtest import simulate
+
+class PrefetchTest(unittest.TestCase):
+    def check_released(self, depth):
+        s = simulate([ '-n', '4', '-c', '2', '-s', 'rr',
+                       '--prefetch', str(depth) ])
+        afs = s.afs
+        self.assertTrue(afs.num_prefetches > depth)
+        self.assertEqual(afs.n_prefetching, 0)
+        self.assertEqual(afs.prefetch_bytes, 0)
+        self.assertEqual(len(afs.inflight), 0)
+        self.assertEqual(len(afs.prefetched), 0)
+
+    def test_depth_1(self):
+        self.check_released(1)
+
+    def test_depth_4(self):
+        self.check_released(4)
+
+    def test_budget(self):
+        s = simulate([ '-n', '4', '-c', '2', '-s', 'rr', '--prefetch', '4',
+                       '--prefetch-budget', '1000000' ])
+        self.assertEqual(s.afs.n_prefetching, 0)
+        self.assertEqual(s.afs.prefetch_bytes, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+import unittest
+
+from simtest import simulate
+import sched
+
+class PrepareTest(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.task_prepared = sched.SchedLocality.task_prepared
+        def spy(scheduler, ready_list):
+            self.batches.append(len(ready_list))
+            return self.task_prepared(scheduler, ready_list)
+        sched.SchedLocality.task_prepared = spy
+
+    def tearDown(self):
+        sched.SchedLocality.task_prepared = self.task_prepared
+
+    def check(self, argv):
+        s = simulate([ '-n', '4', '-c', '2', '-s', 'locality' ] + argv)
+        self.assertEqual(sum(self.batches), len(s.afs.job.tasks))
+        self.assertEqual(len(s.afs.prepared), 0)
+        self.assertEqual(s.afs.prepare_event, None)
+        return s
+
+    def test_simultaneous(self):
+        # the tasks prepared at the same time go together
+        self.check([])
+        self.assertTrue(max(self.batches) > 1)
+
+    def test_serial(self):
+        # one by one, as the emulator
+        self.check([ '--serial-prepare' ])
+        self.assertEqual(set(self.batches), set([ 1 ]))
+
+    def test_window(self):
+        self.check([])
+        simultaneous = len(self.batches)
+        self.batches = []
+        self.check([ '--prepare-window', '5' ])
+        self.assertTrue(len(self.batches) < simultaneous)
+
+
+if __name__ == '__main__':
+    unittest.main()
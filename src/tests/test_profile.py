@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+
+import unittest
+
+from simtest import simulate
+
+class ProfileTest(unittest.TestCase):
+    def test_task_queues(self):
+        s = simulate([ '-n', '4', '-c', '2' ], profile=10)
+        samples = s.get_profile().summary()['gauges']['task_queues']
+        self.assertTrue(len(samples) > 0)
+        n_tasks = len(s.afs.job.tasks)
+        for (now, (submitted, prepared, dispatched)) in samples:
+            self.assertTrue(0 <= now <= s.finish)
+            self.assertTrue(0 < submitted + prepared + dispatched <= n_tasks)
+        self.assertEqual(s.afs.get_queue_depths(), (0, 0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
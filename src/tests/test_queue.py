@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import random
+import unittest
+
+import simtest
+import event
+
+def new_event(ts, i):
+    e = event.TimeoutEvent(event.TASK, ts, None)
+    e.set_context(i)
+    return e
+
+def hold(queue, seed, quantum, n=3000, population=200):
+    """hold model with random cancellations, returns the batches as
+    (timestamp, ids in the order of the batch)
+    """
+    rs = random.Random(seed)
+    pending = []
+    batches = []
+    now = 0.0
+    for i in range(n):
+        if len(pending) < population:
+            delay = round(rs.expovariate(1.0) / quantum) * quantum
+            e = new_event(now + delay, i)
+            pending.append(queue.push(e))
+        if rs.random() < 0.1:
+            h = pending.pop(rs.randrange(len(pending)))
+            if not h.is_cancelled():
+                queue.cancel(h)
+        if rs.random() < 0.5 and len(queue) > 0:
+            events = queue.pop_batch()
+            now = events[0].timeout
+            batches.append((now, [ e.get_context() for e in events ]))
+    while len(queue) > 0:
+        events = queue.pop_batch()
+        batches.append((events[0].timeout,
+                        [ e.get_context() for e in events ]))
+    return batches
+
+class CalendarTest(unittest.TestCase):
+    def test_same_batches(self):
+        # the heap hands the simultaneous events in no particular order
+        for (seed, quantum) in [ (0, 0.01), (1, 0.001), (2, 1.0), (3, 1e-9) ]:
+            heap = hold(event.HeapEventQueue(), seed, quantum)
+            calendar = hold(event.CalendarEventQueue(), seed, quantum)
+            self.assertEqual([ (t, sorted(ids)) for (t, ids) in heap ],
+                             [ (t, sorted(ids)) for (t, ids) in calendar ])
+
+    def test_fifo(self):
+        # registration order within a timestamp
+        for (t, ids) in hold(event.CalendarEventQueue(), 4, 0.1):
+            self.assertEqual(ids, sorted(ids))
+
+    def test_cancel(self):
+        q = event.CalendarEventQueue()
+        handles = [ q.push(new_event(float(i % 5), i)) for i in range(20) ]
+        for h in handles[::2]:
+            q.cancel(h)
+        for i in (5, 15, 7, 17):    # timestamps 0 and 2 only hold tombstones
+            q.cancel(handles[i])
+        self.assertEqual(len(q), 6)
+        self.assertEqual(q.peek(), 1.0)
+        self.assertEqual([ e.get_context() for e in q.pop_batch() ],
+                         [ 1, 11 ])
+        self.assertEqual([ e.get_context() for e in q.pop_batch() ],
+                         [ 3, 13 ])
+        self.assertEqual(len(q), 2)
+
+    def test_stale_width(self):
+        # timestamps closer than the day width of the initial estimate
+        q = event.CalendarEventQueue()
+        q.resize(64, 1e-15)
+        for i in range(100):
+            q.push(new_event(i * 0.1, i))
+        for i in range(100):
+            q.pop_batch()
+            q.push(new_event(10.0 + i * 0.1, i))
+        self.assertTrue(q.width > 1e-3)
+        self.assertTrue(q.scanned <= q.SCAN * max(q.popped, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
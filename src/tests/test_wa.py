@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+import time
+import unittest
+from itertools import permutations
+
+import numpy as np
+
+import simtest
+import sched
+
+def assign(wa, capacity):
+    return sched.SchedWA.assign.im_func(None, wa, capacity)
+
+class AssignTest(unittest.TestCase):
+    def test_optimal(self):
+        # exhaustive search over the slots (capacity per AFE) on small sizes
+        rs = np.random.RandomState(0)
+        for it in range(100):
+            (n_tasks, n_afes) = (rs.randint(1, 7), rs.randint(1, 4))
+            wa = np.round(rs.rand(n_tasks, n_afes) * 4) / 4
+            capacity = (n_tasks + n_afes - 1) / n_afes
+            osd = assign(wa, capacity)
+            self.assertTrue(np.bincount(osd).max() <= capacity)
+            slots = [ j for j in range(n_afes) for c in range(capacity) ]
+            best = min([ sum(wa[range(n_tasks), list(p[:n_tasks])])
+                         for p in permutations(slots) ])
+            self.assertAlmostEqual(wa[range(n_tasks), osd].sum(), best)
+
+    def test_timing(self):
+        # used to be quadratic in the number of tasks (several seconds)
+        wa = np.random.RandomState(0).rand(5000, 8)
+        start = time.time()
+        osd = assign(wa, 625)
+        self.assertTrue(time.time() - start < 2.0)
+        self.assertEqual(np.bincount(osd).max(), 625)
+
+
+if __name__ == '__main__':
+    unittest.main()